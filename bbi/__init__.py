@@ -10,8 +10,11 @@ from ._bbi import (
     chromsizes,
     zooms,
     fetch_intervals,
+    fetch_intervals_arrays,
     fetch,
+    fetch_batch,
     stackup,
+    close_all,
 )
 
 del cbbi, _bbi
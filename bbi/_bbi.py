@@ -1,8 +1,25 @@
+import contextlib
+import copy
+import functools
+import os
+import os.path as op
+import threading
+
 import numpy as np
 
 from . import cbbi
 
-__all__ = ["info", "chromsizes", "zooms", "fetch_intervals", "fetch", "stackup"]
+__all__ = [
+    "info",
+    "chromsizes",
+    "zooms",
+    "fetch_intervals",
+    "fetch_intervals_arrays",
+    "fetch",
+    "fetch_batch",
+    "stackup",
+    "close_all",
+]
 
 
 def documented_by(original):
@@ -13,6 +30,99 @@ def documented_by(original):
     return wrapper
 
 
+def _file_key(inFile):
+    path = op.abspath(inFile)
+    st = os.stat(path)
+    return path, st.st_mtime_ns, st.st_size
+
+
+@functools.lru_cache(maxsize=32)
+def _open_cached(path, mtime, size, thread_id):
+    return cbbi.open(path)
+
+
+if hasattr(os, "register_at_fork"):
+    # A forked child shares its parent's file descriptors and offsets, so
+    # it must not reuse the parent's handles.
+    os.register_at_fork(after_in_child=_open_cached.cache_clear)
+
+
+@contextlib.contextmanager
+def _get(inFile):
+    """
+    Provide an open BBIFile for the duration of a function API call.
+
+    Handles to local files are kept open in an LRU cache keyed on absolute
+    path, modification time and size, so repeated queries against the same file do
+    not re-read its header, chromosome tree and zoom index. A handle serializes
+    its reads, so each thread gets its own, and the cache is emptied in a
+    child process started with ``fork()``. The cache holds at most 32 handles,
+    one per (file, thread) pair, so a pool of 8 threads cycling over more
+    than 4 files keeps reopening them. The handle is not closed on exit:
+    it is released once evicted or after ``close_all()`` and no longer
+    referenced. Remote files are opened and closed on every call.
+
+    """
+    if cbbi._is_url(inFile):
+        with cbbi.open(inFile) as f:
+            yield f
+    else:
+        yield _open_cached(*_file_key(inFile), threading.get_ident())
+
+
+@contextlib.contextmanager
+def _advise_sequential(f):
+    """
+    Hint the kernel to read ahead aggressively while scanning a local file.
+
+    Used around queries that sweep large parts of a file in order, such as
+    stackups (whose intervals are queried in file order) and eager interval
+    fetches. The default access pattern is restored afterwards, so the page
+    cache stays warm for subsequent queries on the same handle. This is a
+    no-op for remote files and on platforms without ``posix_fadvise``.
+
+    """
+    fd = f.fd if hasattr(os, "posix_fadvise") else None
+    if fd is None:
+        yield
+        return
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    try:
+        yield
+    finally:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_NORMAL)
+
+
+@functools.lru_cache(maxsize=64)
+def _read_metadata_cached(path, mtime, size, attr):
+    return cbbi._read_metadata(path, attr)
+
+
+def _read_metadata(inFile, attr):
+    """
+    Return one of the metadata properties of a BBIFile.
+
+    Results for local files are memoized on absolute path, modification time
+    and size, so callers that query metadata before every fetch don't walk
+    the chromosome tree or zoom list again. Callers get a copy of the
+    memoized value, which they are free to modify. The file is read with a
+    raw kent handle that is closed straight away, so sweeping metadata over
+    many files does not evict the query handles cached by ``_get``.
+
+    """
+    if cbbi._is_url(inFile):
+        return cbbi._read_metadata(inFile, attr)
+    return copy.deepcopy(_read_metadata_cached(*_file_key(inFile), attr))
+
+
+def close_all():
+    """
+    Release all file handles kept open by the function API.
+
+    """
+    _open_cached.cache_clear()
+
+
 def chromsizes(inFile):
     """
     Fetch the chromosome list of a bbi file. Returns an ordered dictionary of
@@ -28,8 +138,7 @@ def chromsizes(inFile):
     OrderedDict (str -> int)
 
     """
-    with cbbi.open(inFile) as f:
-        return f.chromsizes
+    return _read_metadata(inFile, "chromsizes")
 
 
 def zooms(inFile):
@@ -47,8 +156,7 @@ def zooms(inFile):
     list of int
 
     """
-    with cbbi.open(inFile) as f:
-        return f.zooms
+    return _read_metadata(inFile, "zooms")
 
 
 def info(inFile):
@@ -65,22 +173,79 @@ def info(inFile):
     dict
 
     """
-    with cbbi.open(inFile) as f:
-        return f.info
+    return _read_metadata(inFile, "info")
 
 
 @documented_by(cbbi.BBIFile.fetch)
-def fetch(inFile, chrom, start, end, bins=-1, missing=0.0, oob=np.nan, summary="mean"):
-    with cbbi.open(inFile) as f:
-        return f.fetch(chrom, start, end, bins, missing, oob, summary)
+def fetch(
+    inFile,
+    chrom,
+    start,
+    end,
+    bins=-1,
+    missing=0.0,
+    oob=np.nan,
+    summary="mean",
+    exact=False,
+    dtype=np.float32,
+):
+    with _get(inFile) as f:
+        return f.fetch(
+            chrom, start, end, bins, missing, oob, summary, exact, dtype
+        )
+
+
+@documented_by(cbbi.BBIFile.fetch_batch)
+def fetch_batch(
+    inFile,
+    chroms,
+    starts,
+    ends,
+    bins=-1,
+    missing=0.0,
+    oob=np.nan,
+    summary="mean",
+    exact=False,
+    dtype=np.float32,
+):
+    with _get(inFile) as f:
+        return f.fetch_batch(
+            chroms, starts, ends, bins, missing, oob, summary, exact, dtype
+        )
 
 
 @documented_by(cbbi.BBIFile.stackup)
 def stackup(
-    inFile, chroms, starts, ends, bins=-1, missing=0.0, oob=np.nan, summary="mean"
+    inFile,
+    chroms,
+    starts,
+    ends,
+    bins=-1,
+    missing=0.0,
+    oob=np.nan,
+    summary="mean",
+    nthreads=1,
+    presorted=False,
+    *,
+    exact=False,
+    dtype=np.float32,
+    order="C",
 ):
-    with cbbi.open(inFile) as f:
-        return f.stackup(chroms, starts, ends, bins, missing, oob, summary)
+    with _get(inFile) as f, _advise_sequential(f):
+        return f.stackup(
+            chroms,
+            starts,
+            ends,
+            bins,
+            missing,
+            oob,
+            summary,
+            nthreads,
+            presorted,
+            exact=exact,
+            dtype=dtype,
+            order=order,
+        )
 
 
 @documented_by(cbbi.BBIFile.fetch_intervals)
@@ -91,5 +256,20 @@ def fetch_intervals(
     end,
     iterator=True
 ):
-    with cbbi.open(inFile) as f:
-        return f.fetch_intervals(chrom, start, end, iterator)
+    with _get(inFile) as f:
+        if iterator:
+            return f.fetch_intervals(chrom, start, end, iterator)
+        with _advise_sequential(f):
+            return f.fetch_intervals(chrom, start, end, iterator)
+
+
+@documented_by(cbbi.BBIFile.fetch_intervals_arrays)
+def fetch_intervals_arrays(
+    inFile,
+    chrom,
+    start,
+    end,
+    chunksize=65536,
+):
+    with _get(inFile) as f:
+        return f.fetch_intervals_arrays(chrom, start, end, chunksize)
@@ -5,7 +5,7 @@ from libc.stdio cimport FILE
 from libc.stdlib cimport free
 
 
-cdef extern from "common.h":
+cdef extern from "common.h" nogil:
     ctypedef np.int32_t boolean
     ctypedef np.uint16_t bits16
     ctypedef np.uint32_t bits32
@@ -22,7 +22,7 @@ cdef extern from "common.h":
     void AllocArray(void *pt, size_t size)
 
 
-cdef extern from "localmem.h":
+cdef extern from "localmem.h" nogil:
     cdef struct lm:
         size_t blockSize
         size_t allignMask
@@ -30,6 +30,7 @@ cdef extern from "localmem.h":
 
     lm *lmInit(int blockSize)
     void lmCleanup(lm **pLm)
+    void lmReset(lm *lm)
 
 
 cdef extern from "bPlusTree.h":
@@ -62,7 +63,7 @@ cdef extern from "crTree.h":
         bits32 itemsPerSlot
 
 
-cdef extern from "udc.h":
+cdef extern from "udc.h" nogil:
     cdef struct udcFile:
         pass
 
@@ -70,6 +71,8 @@ cdef extern from "udc.h":
     udcFile *udcFileMayOpen(char *url, char *cacheDir)
     udcFile *udcFileOpen(char *url, char *cacheDir)
     void udcFileClose(udcFile **pFile)
+    boolean udcFileMmap(udcFile *file)
+    int udcFileFd(udcFile *file)
 
 
 cdef extern from "sig.h":
@@ -77,7 +80,7 @@ cdef extern from "sig.h":
     bits32 bigBedSig
 
 
-cdef extern from "bbiFile.h":
+cdef extern from "bbiFile.h" nogil:
     cdef struct bbiFile:
         bbiFile *next
         char *fileName
@@ -150,7 +153,7 @@ cdef extern from "bbiFile.h":
         char *chrom,
         bits32 start,
         bits32 end,
-        lm *lm)
+        lm *lm) nogil
 
     bbiFile *bbiFileOpen(char *fileName, bits32 sig, char *typeName)
     void bbiFileClose(bbiFile **pBwf)
@@ -241,7 +244,7 @@ cdef extern from "bbiFile.h":
         lm *lm)
 
 
-cdef extern from "bigWig.h":
+cdef extern from "bigWig.h" nogil:
     boolean isBigWig(char *fileName)
     bbiFile *bigWigFileOpen(char *fileName)
     bbiInterval *bigWigIntervalQuery(
@@ -274,7 +277,7 @@ cdef extern from "bigWig.h":
         bbiSummaryElement *summary)
 
 
-cdef extern from "bigBed.h":
+cdef extern from "bigBed.h" nogil:
     cdef struct bigBedInterval:
         bigBedInterval *next
         bits32 start, end
@@ -1,20 +1,34 @@
 #!python
 #cython: embedsignature=True
-from six.moves.urllib.request import urlopen
 from six.moves.urllib.parse import urlparse
 from collections import OrderedDict
 import io
+import os
 import os.path as op
 import sys
 import warnings
 
 import numpy as np
 
+cimport cython
+from cython.parallel cimport prange, threadid
 from libc.math cimport sqrt
+from libc.stdlib cimport malloc, calloc
+from cpython.pythread cimport (
+    PyThread_type_lock, PyThread_allocate_lock, PyThread_free_lock,
+    PyThread_acquire_lock, PyThread_release_lock, WAIT_LOCK, NOWAIT_LOCK
+)
 from .cbbi cimport asObject
 
+np.import_array()
+
 bytes_to_int = int.from_bytes
 
+# Block size of the local memory pool kept by each file handle for the
+# interval lists of its queries. Queries that need more grow the pool
+# temporarily; only this first block is kept between queries.
+cdef int QUERY_LM_BLOCK_SIZE = 1 << 16
+
 
 cpdef dict BBI_SUMMARY_TYPES = {
     'mean': bbiSumMean,
@@ -26,6 +40,26 @@ cpdef dict BBI_SUMMARY_TYPES = {
 }
 
 
+cdef bbiSummaryType _get_summary_type(str summary) except *:
+    try:
+        return BBI_SUMMARY_TYPES[summary]
+    except KeyError:
+        raise ValueError(
+            'Invalid summary type "{}". Must be one of: {}.'.format(
+                summary,
+                set(BBI_SUMMARY_TYPES.keys())))
+
+
+cdef int _get_typenum(dtype) except -1:
+    dtype = np.dtype(dtype)
+    if dtype == np.float32:
+        return np.NPY_FLOAT
+    elif dtype == np.float64:
+        return np.NPY_DOUBLE
+    raise ValueError(
+        'Invalid output dtype "{}". Must be float32 or float64.'.format(dtype))
+
+
 # Map AutoSql types to pandas-compatible dtypes
 # http://genomewiki.ucsc.edu/index.php/AutoSql
 cdef dict AUTOSQL_TYPE_MAP = {
@@ -73,6 +107,9 @@ def _read_magic(str uri):
         with io.open(uri, 'rb') as f:
             magic_bytes = f.read(4)
     else:
+        # urllib.request (and http.client with it) is slow to import and only
+        # needed for remote files
+        from six.moves.urllib.request import urlopen
         with urlopen(uri) as r:
             code = r.getcode()
             if code >= 400:
@@ -100,7 +137,8 @@ def _check_sig(str uri):
     return sig
 
 
-cdef double var_from_sums(double sum, double sumSquares, bits64 n):
+@cython.cdivision(True)
+cdef double var_from_sums(double sum, double sumSquares, bits64 n) nogil:
     cdef double var = sumSquares - sum*sum/n
     if n > 1:
         var /= n - 1
@@ -158,7 +196,7 @@ def is_bigbed(inFile):
     return _read_sig(inFile) == bigBedSig
 
 
-def open(str inFile):
+def open(str inFile, bint mmap=False):
     """
     Open a big binary file.
 
@@ -166,13 +204,101 @@ def open(str inFile):
     ----------
     inFile : str
         File path or URL
+    mmap : bool, optional
+        If True, memory-map a local file and serve reads from the mapping
+        instead of issuing a read system call per block. This helps when the
+        same file is queried many times and stays in the page cache. Ignored
+        for URLs. Default is False.
 
     Returns
     -------
     BBIFile
 
     """
-    return BBIFile(inFile)
+    return BBIFile(inFile, mmap)
+
+
+cdef bbiFile *_c_open(bytes path, bits32 sig):
+    # Open a raw kent handle on a bigWig or bigBed resource
+    if sig == bigWigSig:
+        return bigWigFileOpen(path)
+    return bigBedFileOpen(path)
+
+
+cdef _c_advise_sequential(bbiFile *bbi):
+    # Hint the kernel to read ahead on a local kent handle, if it supports it
+    cdef int fd = udcFileFd(bbi.udc)
+    if fd >= 0 and hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+cdef list _c_chrom_list(bbiFile *bbi):
+    # Traverse the chromosome B+ tree into a list of (name, chromId, size)
+    cdef bbiChromInfo *chromList = bbiChromList(bbi)
+    cdef bbiChromInfo *info = chromList
+    cdef list entries = []
+    while info != NULL:
+        entries.append((<bytes>info.name, <int>info.id, <int>info.size))
+        info = info.next
+
+    # clean up
+    bbiChromInfoFreeList(&chromList)
+    return entries
+
+
+cdef list _c_zooms(bbiFile *bbi):
+    # Traverse the zoom list
+    cdef bbiZoomLevel *zoom = bbi.levelList
+    cdef list z_list = []
+    while zoom != NULL:
+        z_list.append(zoom.reductionLevel)
+        zoom = zoom.next
+    return z_list
+
+
+cdef dict _c_info(bbiFile *bbi):
+    cdef bbiSummaryElement summ = bbiTotalSummary(bbi)
+    return {
+        'version': bbi.version,
+        'isCompressed': bbi.uncompressBufSize > 0,
+        'isSwapped': bbi.isSwapped,
+        'primaryDataSize': bbi.unzoomedIndexOffset - bbi.unzoomedDataOffset,
+        'zoomLevels': bbi.zoomLevels,
+        'chromCount': bbi.chromBpt.itemCount,
+        'summary': {
+            'basesCovered': summ.validCount,
+            'sum': summ.sumData,
+            'mean': summ.sumData / summ.validCount,
+            'min': summ.minVal,
+            'max': summ.maxVal,
+            'std': sqrt(var_from_sums(summ.sumData,
+                                      summ.sumSquares,
+                                      summ.validCount)),
+        }
+    }
+
+
+def _read_metadata(str inFile, str attr):
+    """
+    Read one of the 'chromsizes', 'zooms' or 'info' properties of a bbi file
+    without constructing a BBIFile. The file is opened and closed at the C
+    level.
+
+    """
+    cdef bits32 sig = _check_sig(inFile)
+    cdef bbiFile *bbi = _c_open(inFile.encode('utf-8'), sig)
+    try:
+        if attr == 'chromsizes':
+            return OrderedDict(
+                (name.decode('ascii'), size)
+                for name, _, size in _c_chrom_list(bbi))
+        elif attr == 'zooms':
+            return _c_zooms(bbi)
+        elif attr == 'info':
+            return _c_info(bbi)
+        raise ValueError("Unknown metadata property: {}".format(attr))
+    finally:
+        bbiFileClose(&bbi)
 
 
 cdef class BBIFile:
@@ -182,6 +308,11 @@ cdef class BBIFile:
     The resource may be a bigWig or a bigBed file.
     BigBed AutoSql schemas are supported.
 
+    Queries release the GIL while reading from the file, so separate BBIFile
+    objects can be queried concurrently from multiple threads. A single
+    BBIFile can be shared between threads too, but its reads are serialized
+    by a per-handle lock: open one per thread for parallel reads.
+
     """
     cdef bbiFile *bbi
     cdef bits32 sig
@@ -189,22 +320,57 @@ cdef class BBIFile:
     cdef readonly bint is_remote
     cdef readonly bint is_bigwig
     cdef readonly bint is_bigbed
-
-    def __cinit__(self, str inFile):
-        cdef bytes bInFile = inFile.encode('utf-8')
+    cdef tuple _chrom_names
+    cdef dict _chrom_index
+    cdef tuple _chrom_entries
+    cdef dict _chrom_id_cache
+    cdef lm *_lm
+    cdef PyThread_type_lock _lock
+    cdef bint _mmap
+
+    def __cinit__(self, str inFile, bint mmap=False):
+        # guards self.bbi and self._lm, which kent mutates on every read
+        self._lock = PyThread_allocate_lock()
+        if self._lock == NULL:
+            raise MemoryError
         self.sig = _check_sig(inFile)
-        if self.sig == bigWigSig:
-            self.bbi = bigWigFileOpen(bInFile)
-        else:
-            self.bbi = bigBedFileOpen(bInFile)
         self.path = inFile
         self.is_remote = _is_url(inFile)
         self.is_bigwig = self.sig == bigWigSig
         self.is_bigbed = self.sig == bigBedSig
+        self._mmap = mmap and not self.is_remote
+        self._chrom_id_cache = {}
+        self._lm = lmInit(QUERY_LM_BLOCK_SIZE)
+        self.bbi = self._open_bbi()
+
+    cdef bbiFile *_open_bbi(self):
+        # Open a new kent handle on the resource
+        cdef bbiFile *bbi = _c_open(self.path.encode('utf-8'), self.sig)
+        if self._mmap:
+            udcFileMmap(bbi.udc)
+        return bbi
 
     def __dealloc__(self):
         if self.bbi != NULL:
             bbiFileClose(&self.bbi)
+        if self._lm != NULL:
+            lmCleanup(&self._lm)
+        if self._lock != NULL:
+            PyThread_free_lock(self._lock)
+
+    cdef int _acquire(self) except -1:
+        # Take the handle lock, waiting for it without holding the GIL, and
+        # check that the file is still open. Pair with _release.
+        if not PyThread_acquire_lock(self._lock, NOWAIT_LOCK):
+            with nogil:
+                PyThread_acquire_lock(self._lock, WAIT_LOCK)
+        if self.bbi == NULL:
+            PyThread_release_lock(self._lock)
+            raise OSError("File closed")
+        return 0
+
+    cdef void _release(self):
+        PyThread_release_lock(self._lock)
 
     def __enter__(self):
         return self
@@ -213,13 +379,33 @@ cdef class BBIFile:
         self.close()
 
     def close(self):
-        if self.bbi != NULL:
-            bbiFileClose(&self.bbi)
+        if not PyThread_acquire_lock(self._lock, NOWAIT_LOCK):
+            with nogil:
+                PyThread_acquire_lock(self._lock, WAIT_LOCK)
+        try:
+            if self.bbi != NULL:
+                bbiFileClose(&self.bbi)
+            if self._lm != NULL:
+                lmCleanup(&self._lm)
+        finally:
+            PyThread_release_lock(self._lock)
 
     @property
     def closed(self):
         return self.bbi == NULL
 
+    @property
+    def fd(self):
+        """
+        OS-level file descriptor of a local file, or None for a remote file.
+        The descriptor belongs to the BBIFile and must not be closed.
+
+        """
+        self._acquire()
+        cdef int fd = udcFileFd(self.bbi.udc)
+        self._release()
+        return fd if fd >= 0 else None
+
     def read_autosql(self):
         if self.bbi == NULL:
             raise OSError("File closed")
@@ -229,9 +415,7 @@ cdef class BBIFile:
 
         # Try to read autosql definition string
         # Otherwise use default autosql BED definition based on number of fields
-        cdef char *cText = bigBedAutoSqlText(self.bbi)
-        if cText == NULL:
-            cText = bedAsDef(self.bbi.definedFieldCount, self.bbi.fieldCount)
+        cdef char *cText = self._autosql_text()
         cdef str text = (<bytes>cText).decode('ascii')
         freeMem(cText)
         return text
@@ -262,9 +446,7 @@ cdef class BBIFile:
 
         # Try to read autosql definition string
         # Otherwise use default autosql BED definition based on number of fields
-        cdef char *cText = bigBedAutoSqlText(self.bbi)
-        if cText == NULL:
-            cText = bedAsDef(self.bbi.definedFieldCount, self.bbi.fieldCount)
+        cdef char *cText = self._autosql_text()
 
         # Parse definition string into an object and free the string
         # cdef str raw_text = (<bytes>cText).decode('ascii')
@@ -318,27 +500,91 @@ cdef class BBIFile:
             'description': describe,
         }
 
+    cdef char *_autosql_text(self) except NULL:
+        # The file's autosql definition, or the default BED definition for
+        # its number of fields. The caller frees the string.
+        self._acquire()
+        cdef char *cText = bigBedAutoSqlText(self.bbi)
+        if cText == NULL:
+            cText = bedAsDef(self.bbi.definedFieldCount, self.bbi.fieldCount)
+        self._release()
+        return cText
+
+    cdef _load_chroms(self):
+        # Traverse the chromosome list once and keep the names and sizes
+        if self._chrom_names is not None:
+            return
+
+        self._acquire()
+        try:
+            entries = _c_chrom_list(self.bbi)
+        finally:
+            self._release()
+        cdef list names = [entry[0].decode('ascii') for entry in entries]
+
+        self._chrom_names = tuple(names)
+        self._chrom_index = {name: i for i, name in enumerate(names)}
+        self._chrom_entries = tuple(entries)
+        self._chrom_id_cache.update(zip(names, entries))
+
     @property
     def chromsizes(self):
         """
-        An ordered dictionary of chromosome names mapped to their sizes in bp.
+        An ordered dictionary of chromosome names to their sizes in bp.
+
+        The chromosome list is read once, on first access. Each access
+        returns a new dictionary.
 
         """
         if self.bbi == NULL:
             raise OSError("File closed")
+        self._load_chroms()
+        return OrderedDict(zip(self._chrom_names,
+                               [entry[2] for entry in self._chrom_entries]))
+
+    cdef tuple _lookup_chrom(self, object chrom):
+        # Resolve a chromosome name to (encoded name, chromId, size). Results
+        # are cached, so repeated queries on a chromosome skip the B+ tree
+        # lookup. Names may be str subclasses, e.g. numpy.str_.
+        chrom = str(chrom)
+        try:
+            return self._chrom_id_cache[chrom]
+        except KeyError:
+            pass
+        cdef bytes chromName = chrom.encode('ascii')
+        cdef int chromId, chromSize
+        self._acquire()
+        chromId = bbiChromId(self.bbi, chromName)
+        chromSize = bbiChromSize(self.bbi, chromName) if chromId >= 0 else 0
+        self._release()
+        if chromId < 0:
+            raise KeyError("Chromosome not found: {}".format(chrom))
+        cdef tuple entry = (chromName, chromId, chromSize)
+        self._chrom_id_cache[chrom] = entry
+        return entry
 
-        # traverse the chromosome list
-        cdef bbiChromInfo *chromList = bbiChromList(self.bbi)
-        cdef bbiChromInfo *info = chromList
-        cdef list c_list = []
-        while info != NULL:
-            c_list.append((<bytes>(info.name).decode('ascii'), info.size))
-            info = info.next
+    def chrom_index(self, str chrom):
+        """
+        Return the position of a chromosome in the file's chromosome list,
+        i.e. in the iteration order of ``chromsizes``.
 
-        # clean up
-        bbiChromInfoFreeList(&chromList)
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
 
-        return OrderedDict(c_list)
+        Returns
+        -------
+        int
+
+        """
+        if self.bbi == NULL:
+            raise OSError("File closed")
+        self._load_chroms()
+        try:
+            return self._chrom_index[chrom]
+        except KeyError:
+            raise KeyError("Chromosome not found: {}".format(chrom))
 
     @property
     def zooms(self):
@@ -347,17 +593,11 @@ cdef class BBIFile:
         summary item.
 
         """
-        if self.bbi == NULL:
-            raise OSError("File closed")
-
-        # traverse the zoom list
-        cdef bbiZoomLevel *zoom = self.bbi.levelList
-        cdef list z_list = []
-        while zoom != NULL:
-            z_list.append(zoom.reductionLevel)
-            zoom = zoom.next
-
-        return z_list
+        self._acquire()
+        try:
+            return _c_zooms(self.bbi)
+        finally:
+            self._release()
 
     @property
     def info(self):
@@ -365,29 +605,11 @@ cdef class BBIFile:
         A dict of information about the bbi file.
 
         """
-        if self.bbi == NULL:
-            raise OSError("File closed")
-
-        cdef bbiSummaryElement summ = bbiTotalSummary(self.bbi)
-
-        return {
-            'version': self.bbi.version,
-            'isCompressed': self.bbi.uncompressBufSize > 0,
-            'isSwapped': self.bbi.isSwapped,
-            'primaryDataSize': self.bbi.unzoomedIndexOffset - self.bbi.unzoomedDataOffset,
-            'zoomLevels': self.bbi.zoomLevels,
-            'chromCount': len(self.chromsizes),
-            'summary': {
-                'basesCovered': summ.validCount,
-                'sum': summ.sumData,
-                'mean': summ.sumData / summ.validCount,
-                'min': summ.minVal,
-                'max': summ.maxVal,
-                'std': sqrt(var_from_sums(summ.sumData,
-                                          summ.sumSquares,
-                                          summ.validCount)),
-            }
-        }
+        self._acquire()
+        try:
+            return _c_info(self.bbi)
+        finally:
+            self._release()
 
     def fetch(
         self,
@@ -397,7 +619,9 @@ cdef class BBIFile:
         int bins=-1,
         double missing=0.0,
         double oob=np.nan,
-        str summary='mean'
+        str summary='mean',
+        bint exact=False,
+        dtype=np.float32
     ):
         """
         Read the signal data in a bbi file overlapping a genomic query interval
@@ -429,6 +653,14 @@ cdef class BBIFile:
             Summary statistic to use if summarizing. Options are 'mean', 'min',
             'max', 'cov' (coverage), and 'std' (standard deviation). Default is
             'mean'.
+        exact : bool, optional
+            If True and summarizing, compute the summary statistic from the
+            base pair level data instead of interpolating from the closest
+            zoom level. Slower but exact. Default is False.
+        dtype : numpy dtype, optional
+            Output data type: float32 (the precision of bigWig values) or
+            float64. Summary statistics are computed in double precision
+            either way. Default is float32.
 
         Returns
         -------
@@ -448,18 +680,72 @@ cdef class BBIFile:
         if self.bbi == NULL:
             raise OSError("File closed")
 
+        chromName, chromId, chromSize = self._lookup_chrom(chrom)
+        return self._fetch(
+            chromName, chromId, chromSize, start, end, bins, missing, oob,
+            summary, exact, _get_typenum(dtype))
+
+    def fetch_by_id(
+        self,
+        int chrom_id,
+        int start,
+        int end,
+        int bins=-1,
+        double missing=0.0,
+        double oob=np.nan,
+        str summary='mean',
+        bint exact=False,
+        dtype=np.float32
+    ):
+        """
+        Like ``fetch``, but with the chromosome given by its position in the
+        file's chromosome list (see ``chrom_index``). Skips the name lookup,
+        for use in hot loops.
+
+        Parameters
+        ----------
+        chrom_id : int
+            Position of the chromosome in the iteration order of
+            ``chromsizes``.
+
+        See ``fetch`` for the remaining parameters.
+
+        Returns
+        -------
+        1D ndarray
+
+        """
+        if self.bbi == NULL:
+            raise OSError("File closed")
+
+        self._load_chroms()
+        if chrom_id < 0 or chrom_id >= len(self._chrom_entries):
+            raise IndexError("Chromosome index out of range: {}".format(chrom_id))
+        chromName, chromId, chromSize = self._chrom_entries[chrom_id]
+        return self._fetch(
+            chromName, chromId, chromSize, start, end, bins, missing, oob,
+            summary, exact, _get_typenum(dtype))
+
+    cdef np.ndarray _fetch(
+        self,
+        bytes chromName,
+        int chromId,
+        int chromSize,
+        int start,
+        int end,
+        int bins,
+        double missing,
+        double oob,
+        str summary,
+        bint exact,
+        int typenum
+    ):
         cdef BbiFetchIntervals fetcher
         if self.is_bigwig:
             fetcher = bigWigIntervalQuery
         elif self.is_bigbed:
             fetcher = bigBedCoverageIntervals
 
-        # find the chromosome
-        cdef bytes chromName = chrom.encode('ascii')
-        cdef int chromSize = bbiChromSize(self.bbi, chromName)
-        if chromSize == 0:
-            raise KeyError("Chromosome not found: {}".format(chrom))
-
         # check the coordinates
         if end < 0:
             end = chromSize
@@ -478,26 +764,32 @@ cdef class BBIFile:
             is_summary = False
             bins = length
 
-        cdef np.ndarray[np.double_t, ndim=1] out = np.empty(bins, dtype=float)
-        out[:] = missing
+        cdef np.npy_intp dims[1]
+        dims[0] = bins
+        cdef np.ndarray out = np.PyArray_EMPTY(1, dims, typenum, 0)
 
         # query
-        cdef bbiSummaryType summary_type
+        cdef bbiSummaryType summary_type = bbiSumMean
         if is_summary:
-            try:
-                summary_type = BBI_SUMMARY_TYPES[summary]
-            except KeyError:
-                raise ValueError(
-                    'Invalid summary type "{}". Must be one of: {}.'.format(
-                        summary,
-                        set(BBI_SUMMARY_TYPES.keys())))
-            array_query_summarized(
-                out, bins, self.bbi, fetcher,
-                chromName, start, end, chromSize, oob, summary_type)
-        else:
-            array_query_full(
-                out, bins, self.bbi, fetcher,
-                chromName, start, end, chromSize, oob)
+            summary_type = _get_summary_type(summary)
+        cdef char *cChromName = chromName
+        cdef float *pOutF = <float *>np.PyArray_DATA(out)
+        cdef double *pOutD = <double *>np.PyArray_DATA(out)
+        self._acquire()
+        try:
+            with nogil:
+                if typenum == np.NPY_FLOAT:
+                    _query_one(
+                        pOutF, bins, self.bbi, self._lm, fetcher, cChromName,
+                        chromId, start, end, chromSize, missing, oob,
+                        is_summary, summary_type, exact)
+                else:
+                    _query_one(
+                        pOutD, bins, self.bbi, self._lm, fetcher, cChromName,
+                        chromId, start, end, chromSize, missing, oob,
+                        is_summary, summary_type, exact)
+        finally:
+            self._release()
 
         return out
 
@@ -509,7 +801,13 @@ cdef class BBIFile:
         int bins=-1,
         double missing=0.0,
         double oob=np.nan,
-        str summary='mean'
+        str summary='mean',
+        int nthreads=1,
+        bint presorted=False,
+        *,
+        bint exact=False,
+        dtype=np.float32,
+        str order='C'
     ):
         """
         Vertically stack signal tracks from equal-length bbi query intervals.
@@ -536,6 +834,29 @@ cdef class BBIFile:
             Summary statistic to use if summarizing. Options are 'mean', 'min',
             'max', 'cov' (coverage), and 'std' (standard deviation). Default is
             'mean'.
+        nthreads : int, optional
+            Number of OpenMP threads to distribute the query intervals over.
+            Each extra thread opens its own handle on the file, advised for
+            sequential reads. Default is 1.
+        presorted : bool, optional
+            Whether the query intervals are already sorted by genomic position
+            in the file's chromosome order. Otherwise, they are queried in that
+            order, which turns scattered reads into a near-sequential scan of
+            the file, and the rows are returned in input order. Default is
+            False.
+        exact : bool, optional
+            If True and summarizing, compute the summary statistic from the
+            base pair level data instead of interpolating from the closest
+            zoom level. Slower but exact. Default is False.
+        dtype : numpy dtype, optional
+            Output data type: float32 (the precision of bigWig values) or
+            float64. Summary statistics are computed in double precision
+            either way. Default is float32.
+        order : {'C', 'F'}, optional
+            Memory layout of the output. 'C' (default) stores each interval's
+            track contiguously, 'F' stores each bin across all intervals
+            contiguously, which favors per-bin reductions over the intervals
+            (e.g. ``out.mean(axis=0)``) at a slightly higher fill cost.
 
         Returns
         -------
@@ -550,18 +871,15 @@ cdef class BBIFile:
             raise OSError("File closed")
 
         cdef np.ndarray[object, ndim=1] chroms_ = np.asarray(chroms, dtype=object)
-        cdef np.ndarray[np.int_t, ndim=1] starts_ = np.asarray(starts, dtype=int)
-        cdef np.ndarray[np.int_t, ndim=1] ends_ = np.asarray(ends, dtype=int)
-        if bins < 0 and (len(chroms_) != len(starts_) or len(starts_) != len(ends_)):
+        cdef np.ndarray[np.int64_t, ndim=1] starts_ = np.ascontiguousarray(starts, dtype=np.int64)
+        cdef np.ndarray[np.int64_t, ndim=1] ends_ = np.ascontiguousarray(ends, dtype=np.int64)
+        if len(chroms_) != len(starts_) or len(starts_) != len(ends_):
             raise ValueError(
                 "`chroms`, `starts`, and `ends` must have the same length"
             )
 
-        cdef BbiFetchIntervals fetcher
-        if self.is_bigwig:
-            fetcher = bigWigIntervalQuery
-        elif self.is_bigbed:
-            fetcher = bigBedCoverageIntervals
+        if order not in ('C', 'F'):
+            raise ValueError("`order` must be 'C' or 'F', got {!r}".format(order))
 
         # check the coordinate inputs
         if bins < 0 and len(np.unique(ends_ - starts_)) != 1:
@@ -569,49 +887,327 @@ cdef class BBIFile:
                 "Query windows must have equal size if `bins` is not specified."
             )
 
+        # find the chromosomes
+        cdef list chromNames
+        cdef np.ndarray[np.int64_t, ndim=1] chromCodes, chromIds, chromSizes
+        chromNames, chromCodes, chromIds, chromSizes = self._resolve_chroms(chroms_)
+        bad = np.flatnonzero(starts_ > chromSizes)
+        if len(bad):
+            raise ValueError(
+                "Start exceeds the chromosome length, {}.".format(
+                    chromSizes[bad[0]]))
+
         # prepare output
         cdef int length = ends_[0] - starts_[0]
         cdef int n = chroms_.shape[0]
-        if bins < 1:
-            bins = length
-        cdef np.ndarray[np.double_t, ndim=2] out = np.empty((n, bins), dtype=float)
-        out[:, :] = missing
+        cdef int ncols = bins if bins >= 1 else length
+        cdef bbiSummaryType summary_type = bbiSumMean
+        if bins >= 1:
+            summary_type = _get_summary_type(summary)
+        cdef np.npy_intp dims[2]
+        dims[0] = n
+        dims[1] = ncols
+        cdef bint fortran = order == 'F'
+        cdef np.ndarray out = np.PyArray_EMPTY(
+            2, dims, _get_typenum(dtype), fortran)
+
+        # visit the intervals in file order
+        cdef np.ndarray[np.int64_t, ndim=1] visit
+        if presorted:
+            visit = np.arange(n, dtype=np.int64)
+        else:
+            self._load_chroms()
+            chromIx = np.array(
+                [self._chrom_index[(<bytes>name).decode('ascii')]
+                 for name in chromNames],
+                dtype=np.int64)[chromCodes]
+            visit = np.lexsort((starts_, chromIx)).astype(np.int64)
 
         # query
-        cdef bytes chromName
-        cdef int chromSize
-        cdef int start, end
+        self._query_batch(
+            out, np.arange(n + 1, dtype=np.int64) * ncols,
+            chromNames, chromCodes, chromIds, chromSizes, starts_, ends_, visit,
+            bins, missing, oob, summary_type, exact, nthreads,
+            n if fortran and n > 1 else 1, True
+        )
+        return out
+
+    def fetch_batch(
+        self,
+        chroms,
+        starts,
+        ends,
+        int bins=-1,
+        double missing=0.0,
+        double oob=np.nan,
+        str summary='mean',
+        bint exact=False,
+        dtype=np.float32
+    ):
+        """
+        Read the signal data overlapping several genomic query intervals.
+
+        Equivalent to calling ``fetch`` on each interval in turn, but all
+        queries are driven from a single loop over the open file and written
+        into one preallocated buffer. Unlike ``stackup``, the query intervals
+        need not have equal length.
+
+        Parameters
+        ----------
+        chroms : array-like of str
+            Chromosome names.
+        starts : array-like of int
+            Start coordinates. If start is less than zero, the beginning of the
+            track is not truncated but treated as out of bounds.
+        ends : array-like of int
+            End coordinates. If end is less than zero, the end is set to the
+            chromosome size. If end is greater than the chromosome size, the end of
+            the track is not truncated but treated as out of bounds.
+        bins : int, optional
+            Number of bins to divide each query interval into for coarsegraining.
+            Default (-1) means no summarization (i.e., 1 bp bins).
+        missing : float, optional
+            Fill-in value for unreported data in valid regions. Default is 0.
+        oob : float, optional
+            Fill-in value for out-of-bounds regions. Default is NaN.
+        summary : str, optional
+            Summary statistic to use if summarizing. Options are 'mean', 'min',
+            'max', 'cov' (coverage), and 'std' (standard deviation). Default is
+            'mean'.
+        exact : bool, optional
+            If True and summarizing, compute the summary statistic from the
+            base pair level data instead of interpolating from the closest
+            zoom level. Slower but exact. Default is False.
+        dtype : numpy dtype, optional
+            Output data type: float32 (the precision of bigWig values) or
+            float64. Summary statistics are computed in double precision
+            either way. Default is float32.
+
+        Returns
+        -------
+        list of 1D ndarray
+            One array per query interval. The arrays are views into a single
+            contiguous buffer.
+
+        See Also
+        --------
+        fetch : Fetch the signal track of a single interval
+        stackup : Stack the signal tracks of equal-length intervals
+
+        """
+        if self.bbi == NULL:
+            raise OSError("File closed")
+
+        cdef np.ndarray[object, ndim=1] chroms_ = np.asarray(chroms, dtype=object)
+        cdef np.ndarray[np.int64_t, ndim=1] starts_ = np.ascontiguousarray(starts, dtype=np.int64)
+        cdef np.ndarray[np.int64_t, ndim=1] ends_ = np.array(ends, dtype=np.int64)
+        if len(chroms_) != len(starts_) or len(starts_) != len(ends_):
+            raise ValueError(
+                "`chroms`, `starts`, and `ends` must have the same length"
+            )
+
+        # find the chromosomes and check the coordinates
+        cdef list chromNames
+        cdef np.ndarray[np.int64_t, ndim=1] chromCodes, chromIds, chromSizes
+        chromNames, chromCodes, chromIds, chromSizes = self._resolve_chroms(chroms_)
         cdef Py_ssize_t i
-        cdef bbiSummaryType summary_type
+        cdef int n = chroms_.shape[0]
+        ends_ = np.where(ends_ < 0, chromSizes, ends_)
+        bad = np.flatnonzero(starts_ > chromSizes)
+        if len(bad):
+            raise ValueError(
+                "Start exceeds the chromosome length, {}.".format(
+                    chromSizes[bad[0]]))
+        bad = np.flatnonzero(ends_ < starts_)
+        if len(bad):
+            i = bad[0]
+            raise ValueError(
+                "Interval cannot have negative length:"
+                " start = {}, end = {}.".format(starts_[i], ends_[i]))
+
+        cdef bbiSummaryType summary_type = bbiSumMean
+        if bins >= 1:
+            summary_type = _get_summary_type(summary)
+
+        # prepare the output
+        cdef np.ndarray[np.int64_t, ndim=1] offsets
+        if bins >= 1:
+            offsets = np.arange(n + 1, dtype=np.int64) * bins
+        else:
+            offsets = np.r_[0, np.cumsum(ends_ - starts_)]
+        cdef np.npy_intp dims[1]
+        dims[0] = offsets[n]
+        cdef np.ndarray buf = np.PyArray_EMPTY(1, dims, _get_typenum(dtype), 0)
+
+        # query
+        self._query_batch(
+            buf, offsets, chromNames, chromCodes, chromIds, chromSizes,
+            starts_, ends_,
+            np.arange(n, dtype=np.int64), bins, missing, oob, summary_type,
+            exact, 1
+        )
+        return [buf[offsets[i]:offsets[i + 1]] for i in range(n)]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef tuple _resolve_chroms(self, chroms):
+        # Look up each distinct query chromosome once. Returns the encoded
+        # distinct names, the per-query code into them, and the per-query
+        # chromosome ids and sizes.
+        cdef Py_ssize_t n = len(chroms)
+        cdef dict seen = {}
+        cdef list chromNames = [], ids = [], sizes = []
+        cdef np.ndarray codes = np.empty(n, dtype=np.int64)
+        cdef np.int64_t[::1] pCodes = codes
+        cdef Py_ssize_t i, j
         for i in range(n):
-            chromName = chroms_[i].encode('ascii')
-            chromSize = bbiChromSize(self.bbi, chromName)
-            if chromSize == 0:
-                raise KeyError("Chromosome not found: {}".format(chroms_[i]))
-            start = starts_[i]
-            end = ends_[i]
-            if start > chromSize:
-                raise ValueError(
-                    "Start exceeds the chromosome length, {}.".format(chromSize))
-            if bins < 1:
-                array_query_full(
-                    out[i, :], bins, self.bbi, fetcher,
-                    chromName, start, end, chromSize, oob
-                )
-            else:
-                try:
-                    summary_type = BBI_SUMMARY_TYPES[summary]
-                except KeyError:
-                    raise ValueError(
-                        'Invalid summary type "{}". Must be one of: {}.'.format(
-                            summary,
-                            set(BBI_SUMMARY_TYPES.keys()))
-                        )
-                array_query_summarized(
-                    out[i, :], bins, self.bbi, fetcher,
-                    chromName, start, end, chromSize, oob, summary_type
-                )
-        return out
+            chrom = chroms[i]
+            j = seen.get(chrom, -1)
+            if j < 0:
+                chromName, chromId, chromSize = self._lookup_chrom(chrom)
+                j = seen[chrom] = len(chromNames)
+                chromNames.append(chromName)
+                ids.append(chromId)
+                sizes.append(chromSize)
+            pCodes[i] = j
+        return (
+            chromNames,
+            codes,
+            np.array(ids, dtype=np.int64)[codes],
+            np.array(sizes, dtype=np.int64)[codes],
+        )
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _query_batch(
+        self,
+        np.ndarray out,
+        np.int64_t[::1] offsets,
+        list chromNames,
+        np.int64_t[::1] chromCodes,
+        np.int64_t[::1] chromIds,
+        np.int64_t[::1] chromSizes,
+        np.int64_t[::1] starts,
+        np.int64_t[::1] ends,
+        np.int64_t[::1] order,
+        int bins,
+        double missing,
+        double oob,
+        bbiSummaryType summary_type,
+        bint exact,
+        int nthreads,
+        Py_ssize_t stride=1,
+        bint sequential=False
+    ):
+        # Fill the flat slice [offsets[i], offsets[i+1]) of the C-contiguous
+        # float32 or float64 array out with the signal of query interval i,
+        # on chromosome chromNames[chromCodes[i]], at base pair resolution if
+        # bins < 1. Intervals are visited in the sequence given by order. The
+        # queries are spread over nthreads OpenMP threads. The first thread
+        # works on self.bbi and self._lm, which are locked for the duration of
+        # the batch. kent file handles are not thread-safe, so every extra
+        # thread opens its own, along with its own local memory pool. If
+        # sequential, the extra handles, which only live for this batch, are
+        # advised for read-ahead, since the caller visits the file in order.
+        #
+        # If stride > 1, out is instead a column-major matrix with stride
+        # rows: row i starts at element i and its values are stride elements
+        # apart. Each row is then queried into a contiguous per-thread scratch
+        # buffer and scattered into place.
+        cdef Py_ssize_t n = len(order)
+        cdef Py_ssize_t nchroms = len(chromNames)
+        if nthreads > n:
+            nthreads = n
+        if nthreads < 1:
+            nthreads = 1
+
+        cdef BbiFetchIntervals fetcher
+        if self.is_bigwig:
+            fetcher = bigWigIntervalQuery
+        elif self.is_bigbed:
+            fetcher = bigBedCoverageIntervals
+
+        cdef char **cChromNames = <char **>malloc(max(nchroms, 1) * sizeof(char *))
+        cdef bbiFile **handles = <bbiFile **>calloc(nthreads, sizeof(bbiFile *))
+        cdef lm **arenas = <lm **>calloc(nthreads, sizeof(lm *))
+        cdef Py_ssize_t maxrow = 0
+        cdef double *scratch = NULL
+        if stride > 1:
+            maxrow = np.max(np.diff(offsets), initial=0)
+            scratch = <double *>malloc(max(nthreads * maxrow, 1) * sizeof(double))
+        if (cChromNames == NULL or handles == NULL or arenas == NULL or
+                (stride > 1 and scratch == NULL)):
+            free(cChromNames)
+            free(handles)
+            free(arenas)
+            free(scratch)
+            raise MemoryError
+
+        cdef bint single = np.PyArray_TYPE(out) == np.NPY_FLOAT
+        cdef float *pOutF = <float *>np.PyArray_DATA(out)
+        cdef double *pOutD = <double *>np.PyArray_DATA(out)
+        cdef double *row
+        cdef int nrow
+        cdef Py_ssize_t i, j, k
+        cdef int t, tid
+        cdef bint locked = False
+        try:
+            self._acquire()
+            locked = True
+            for i in range(nchroms):
+                cChromNames[i] = chromNames[i]
+            handles[0] = self.bbi
+            arenas[0] = self._lm
+            for t in range(1, nthreads):
+                handles[t] = self._open_bbi()
+                arenas[t] = lmInit(QUERY_LM_BLOCK_SIZE)
+                if sequential:
+                    _c_advise_sequential(handles[t])
+
+            for k in prange(n, nogil=True, schedule='dynamic', num_threads=nthreads):
+                i = order[k]
+                tid = threadid()
+                nrow = offsets[i + 1] - offsets[i]
+                if stride > 1:
+                    row = scratch + tid * maxrow
+                    _query_one(
+                        row, nrow, handles[tid], arenas[tid], fetcher,
+                        cChromNames[chromCodes[i]], chromIds[i], starts[i], ends[i],
+                        chromSizes[i], missing, oob, bins >= 1, summary_type,
+                        exact
+                    )
+                    if single:
+                        for j in range(nrow):
+                            pOutF[i + j * stride] = <float>row[j]
+                    else:
+                        for j in range(nrow):
+                            pOutD[i + j * stride] = row[j]
+                elif single:
+                    _query_one(
+                        pOutF + offsets[i], nrow, handles[tid], arenas[tid], fetcher,
+                        cChromNames[chromCodes[i]], chromIds[i], starts[i], ends[i],
+                        chromSizes[i], missing, oob, bins >= 1, summary_type,
+                        exact
+                    )
+                else:
+                    _query_one(
+                        pOutD + offsets[i], nrow, handles[tid], arenas[tid], fetcher,
+                        cChromNames[chromCodes[i]], chromIds[i], starts[i], ends[i],
+                        chromSizes[i], missing, oob, bins >= 1, summary_type,
+                        exact
+                    )
+        finally:
+            if locked:
+                self._release()
+            for t in range(1, nthreads):
+                if handles[t] != NULL:
+                    bbiFileClose(&handles[t])
+                if arenas[t] != NULL:
+                    lmCleanup(&arenas[t])
+            free(handles)
+            free(arenas)
+            free(scratch)
+            free(cChromNames)
 
     def fetch_intervals(self, str chrom, int start, int end, bint iterator=False):
         """
@@ -641,11 +1237,80 @@ cdef class BBIFile:
         if self.bbi == NULL:
             raise OSError("File closed")
 
-        # find the chromosome
-        cdef bytes chromName = chrom.encode('ascii')
-        cdef int chromSize = bbiChromSize(self.bbi, chromName)
-        if chromSize == 0:
-            raise KeyError("Chromosome not found: {}".format(chrom))
+        cdef bytes chromName
+        cdef int validStart, validEnd
+        chromName, validStart, validEnd = self._clip_query(chrom, start, end)
+
+        if self.is_bigwig:
+            it = BigWigIntervalIterator(self, chromName, validStart, validEnd)
+        else:
+            it = BigBedIntervalIterator(self, chromName, validStart, validEnd)
+
+        if iterator:
+            return it
+        else:
+            try:
+                import pandas as pd
+            except ImportError:
+                raise ImportError("fetch_intervals requires pandas")
+
+            df = pd.DataFrame(list(it), columns=self.schema['columns'])
+            for col, dtype in self.schema['dtypes'].items():
+                try:
+                    df[col] = df[col].astype(dtype)
+                except:
+                    pass
+
+        return df
+
+    def fetch_intervals_arrays(
+        self, str chrom, int start, int end, int chunksize=65536
+    ):
+        """
+        Return an iterator over the feature intervals overlapping a specified
+        genomic query interval, in chunks of numpy arrays.
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        start : int
+            Start coordinate.
+        end : int
+            End coordinate. If end is less than zero, the end is set to the
+            chromosome size.
+        chunksize : int, optional
+            Maximum number of intervals per chunk. Default is 65536.
+
+        Returns
+        -------
+        IntervalArrayIterator
+            Yields ``(starts, ends, values)`` for a bigWig and
+            ``(starts, ends)`` for a bigBed, as uint32 and float32 arrays.
+            Each chunk is a set of new arrays, safe to keep.
+
+        See Also
+        --------
+        fetch_intervals : Intervals as tuples or as a parsed data frame
+
+        """
+        if self.bbi == NULL:
+            raise OSError("File closed")
+        if chunksize < 1:
+            raise ValueError("chunksize must be positive")
+
+        cdef bytes chromName
+        cdef int validStart, validEnd
+        chromName, validStart, validEnd = self._clip_query(chrom, start, end)
+        return IntervalArrayIterator(
+            self, chromName, validStart, validEnd, chunksize)
+
+    cdef tuple _clip_query(self, str chrom, int start, int end):
+        # Find the chromosome, check the coordinates and clip the query range
+        # to the chromosome. Returns (chromName, validStart, validEnd).
+        cdef bytes chromName
+        cdef int chromSize
+        chromName, _, chromSize = self._lookup_chrom(chrom)
 
         # check the coordinates
         if end < 0:
@@ -666,27 +1331,99 @@ cdef class BBIFile:
         if end > chromSize:
             validEnd = chromSize
 
+        return chromName, validStart, validEnd
+
+
+cdef class IntervalArrayIterator:
+
+    cdef bint is_bigwig
+    cdef int chunksize
+    cdef bbiInterval *interval
+    cdef bigBedInterval *bedInterval
+    cdef lm *lm
+
+    def __init__(
+        self,
+        BBIFile fp,
+        bytes chromName,
+        int validStart,
+        int validEnd,
+        int chunksize
+    ):
+        if fp.closed:
+            raise OSError("File closed")
+        self.is_bigwig = fp.is_bigwig
+        self.chunksize = chunksize
+
+        # interval list is allocated out of lm
+        cdef char *cChromName = chromName
+        fp._acquire()
+        try:
+            with nogil:
+                self.lm = lmInit(0)
+                if self.is_bigwig:
+                    self.interval = bigWigIntervalQuery(
+                        fp.bbi, cChromName, validStart, validEnd, self.lm
+                    )
+                else:
+                    self.bedInterval = bigBedIntervalQuery(
+                        fp.bbi, cChromName, validStart, validEnd, 0, self.lm
+                    )
+        finally:
+            fp._release()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # count the intervals in this chunk
+        cdef np.npy_intp dims[1]
+        cdef bbiInterval *interval = self.interval
+        cdef bigBedInterval *bedInterval = self.bedInterval
+        cdef np.npy_intp n = 0
         if self.is_bigwig:
-            it = BigWigIntervalIterator(self, chromName, validStart, validEnd)
+            while interval != NULL and n < self.chunksize:
+                interval = interval.next
+                n += 1
         else:
-            it = BigBedIntervalIterator(self, chromName, validStart, validEnd)
-
-        if iterator:
-            return it
+            while bedInterval != NULL and n < self.chunksize:
+                bedInterval = bedInterval.next
+                n += 1
+        if n == 0:
+            raise StopIteration
+        dims[0] = n
+
+        # copy them out
+        cdef np.ndarray starts = np.PyArray_EMPTY(1, dims, np.NPY_UINT32, 0)
+        cdef np.ndarray ends = np.PyArray_EMPTY(1, dims, np.NPY_UINT32, 0)
+        cdef bits32 *pStarts = <bits32 *>np.PyArray_DATA(starts)
+        cdef bits32 *pEnds = <bits32 *>np.PyArray_DATA(ends)
+        cdef np.ndarray values
+        cdef float *pValues
+        cdef np.npy_intp i
+        if self.is_bigwig:
+            values = np.PyArray_EMPTY(1, dims, np.NPY_FLOAT32, 0)
+            pValues = <float *>np.PyArray_DATA(values)
+            with nogil:
+                for i in range(n):
+                    pStarts[i] = self.interval.start
+                    pEnds[i] = self.interval.end
+                    pValues[i] = self.interval.val
+                    self.interval = self.interval.next
+            return starts, ends, values
         else:
-            try:
-                import pandas as pd
-            except ImportError:
-                raise ImportError("fetch_intervals requires pandas")
-
-            df = pd.DataFrame(list(it), columns=self.schema['columns'])
-            for col, dtype in self.schema['dtypes'].items():
-                try:
-                    df[col] = df[col].astype(dtype)
-                except:
-                    pass
+            with nogil:
+                for i in range(n):
+                    pStarts[i] = self.bedInterval.start
+                    pEnds[i] = self.bedInterval.end
+                    self.bedInterval = self.bedInterval.next
+            return starts, ends
 
-        return df
+    def __dealloc__(self):
+        self.interval = NULL
+        self.bedInterval = NULL
+        if self.lm != NULL:
+            lmCleanup(&self.lm)
 
 
 cdef class BigWigIntervalIterator:
@@ -705,10 +1442,16 @@ cdef class BigWigIntervalIterator:
         self.valid_end = validEnd
 
         # interval list is allocated out of lm
-        self.lm = lmInit(0)
-        self.interval = bigWigIntervalQuery(
-            fp.bbi, chromName, validStart, validEnd, self.lm
-        )
+        cdef char *cChromName = chromName
+        fp._acquire()
+        try:
+            with nogil:
+                self.lm = lmInit(0)
+                self.interval = bigWigIntervalQuery(
+                    fp.bbi, cChromName, validStart, validEnd, self.lm
+                )
+        finally:
+            fp._release()
 
     def __iter__(self):
         return self
@@ -747,10 +1490,16 @@ cdef class BigBedIntervalIterator:
         self.valid_end = validEnd
         
         # interval list is allocated out of lm
-        self.lm = lmInit(0)
-        self.interval = bigBedIntervalQuery(
-            fp.bbi, chromName, validStart, validEnd, 0, self.lm
-        )
+        cdef char *cChromName = chromName
+        fp._acquire()
+        try:
+            with nogil:
+                self.lm = lmInit(0)
+                self.interval = bigBedIntervalQuery(
+                    fp.bbi, cChromName, validStart, validEnd, 0, self.lm
+                )
+        finally:
+            fp._release()
 
     def __iter__(self):
         return self
@@ -779,17 +1528,68 @@ cdef class BigBedIntervalIterator:
             lmCleanup(&self.lm)
 
 
+cdef inline void _query_one(
+    cython.floating *out,
+    int nbins,
+    bbiFile *bbi,
+    lm *lm,
+    BbiFetchIntervals fetchIntervals,
+    char *chromName,
+    int chromId,
+    int start,
+    int end,
+    int chromSize,
+    double missing,
+    double oob,
+    bint summarize,
+    bbiSummaryType summaryType,
+    bint exact
+) nogil:
+    # Fill out with the signal of one query interval, binned if summarize is
+    # set and at base pair resolution otherwise. Interval lists are allocated
+    # out of lm, which is reset afterwards.
+    if summarize:
+        array_query_summarized(
+            out, nbins, bbi, lm, fetchIntervals, chromName, chromId,
+            start, end, chromSize, missing, oob, summaryType, exact)
+    else:
+        _fill(out, nbins, 0, nbins, missing)
+        array_query_full(
+            out, nbins, bbi, lm, fetchIntervals, chromName,
+            start, end, chromSize, oob)
+    lmReset(lm)
+
+
+cdef inline void _fill(
+    cython.floating *out,
+    Py_ssize_t n,
+    Py_ssize_t lo,
+    Py_ssize_t hi,
+    double val
+) nogil:
+    # Assign val to out[lo:hi] for an array of length n, clipping the range to
+    # the array like a slice
+    cdef Py_ssize_t j
+    if lo < 0:
+        lo = 0
+    if hi > n:
+        hi = n
+    for j in range(lo, hi):
+        out[j] = val
+
+
 cdef inline void array_query_full(
-    np.ndarray[np.double_t, ndim=1] out,
+    cython.floating *out,
     int nbins,
     bbiFile *bbi,
+    lm *lm,
     BbiFetchIntervals fetchIntervals,
-    bytes chromName,
+    char *chromName,
     int start,
     int end,
     int chromSize,
     double oob
-):
+) nogil:
     # Clip the query range
     cdef int validStart = start, validEnd = end
     if start < 0:
@@ -799,7 +1599,6 @@ cdef inline void array_query_full(
 
     # Fill valid regions
     # intervalList is allocated out of lm
-    cdef lm *lm = lmInit(0)
     cdef bbiInterval *intervalList = fetchIntervals(
         bbi, chromName, validStart, validEnd, lm)
 
@@ -815,36 +1614,38 @@ cdef inline void array_query_full(
             saveVal = interval.val
             firstTime = False
         elif not ((interval.start == prevEnd) and (interval.val == saveVal)):
-            out[saveStart-start:prevEnd-start] = saveVal
+            _fill(out, nbins, saveStart-start, prevEnd-start, saveVal)
             saveStart = interval.start
             saveVal = interval.val
         prevEnd = interval.end
         interval = interval.next
     if not firstTime:
-        out[saveStart-start:prevEnd-start] = saveVal
+        _fill(out, nbins, saveStart-start, prevEnd-start, saveVal)
 
     # Fill out-of-bounds regions
     if start < validStart:
-        out[:(validStart - start)] = oob
+        _fill(out, nbins, 0, validStart - start, oob)
     if end >= validEnd:
-        out[(validEnd - start):] = oob
-
-    lmCleanup(&lm)
+        _fill(out, nbins, validEnd - start, nbins, oob)
 
 
+@cython.cdivision(True)
 cdef inline void array_query_summarized(
-    np.ndarray[np.double_t, ndim=1] out,
+    cython.floating *out,
     int nbins,
     bbiFile *bbi,
+    lm *lm,
     BbiFetchIntervals fetchIntervals,
-    bytes chromName,
+    char *chromName,
+    int chromId,
     int start,
     int end,
     int chromSize,
+    double missing,
     double oob,
-    bbiSummaryType summaryType
-):
-
+    bbiSummaryType summaryType,
+    bint exact
+) nogil:
     # Clip the query range
     cdef int validStart = start, validEnd = end
     if start < 0:
@@ -852,13 +1653,17 @@ cdef inline void array_query_summarized(
     if end > chromSize:
         validEnd = chromSize
 
-    # Get the closest zoom level less than what we're looking for
+    # Get the closest zoom level less than what we're looking for, unless
+    # summarizing the base pair level data
     cdef int baseSize = end - start
     cdef int stepSize = baseSize // nbins
     cdef int zoomLevel = stepSize // 2
     if zoomLevel < 0:
         zoomLevel = 0
-    cdef bbiZoomLevel *zoomObj = bbiBestZoom(bbi.levelList, zoomLevel)
+
+    cdef bbiZoomLevel *zoomObj = NULL
+    if not exact:
+        zoomObj = bbiBestZoom(bbi.levelList, zoomLevel)
 
     # Create and populate summary elements
     # elements is allocated
@@ -868,67 +1673,67 @@ cdef inline void array_query_summarized(
     if zoomObj != NULL:
         result = _bbiSummariesFromZoom(
             bbi, zoomObj,
-            chromName, start, end, validStart, validEnd,
+            chromId, start, end, validStart, validEnd,
             elements, nbins)
     else:
         result = _bbiSummariesFromFull(
-            bbi, fetchIntervals,
+            bbi, lm, fetchIntervals,
             chromName, start, end, validStart, validEnd,
             elements, nbins)
 
-    # Fill output array
+    # Fill output array in a single pass: out-of-bounds bins get oob, empty
+    # bins get missing and the rest are finalized from the summary element
     cdef double covFactor = <double>nbins / (end - start)
     cdef bbiSummaryElement *el
     cdef double val
     cdef int loc, i
-    if result:
-        for i in range(nbins):
-            loc = start + i*stepSize
-            if loc < validStart or loc >= validEnd:
+    for i in range(nbins):
+        loc = start + i*stepSize
+        if loc < validStart or loc >= validEnd:
+            if result:
                 out[i] = oob
             else:
-                el = &elements[i]
-                if el.validCount > 0:
-                    if summaryType == bbiSumMean:
-                        val = el.sumData / el.validCount
-                    elif summaryType == bbiSumMax:
-                        val = el.maxVal
-                    elif summaryType == bbiSumMin:
-                        val = el.minVal
-                    elif summaryType == bbiSumCoverage:
-                        val = covFactor * el.validCount
-                    elif summaryType == bbiSumStandardDeviation:
-                        val = sqrt(var_from_sums(el.sumData,
-                                                 el.sumSquares,
-                                                 el.validCount))
-                    elif summaryType == bbiSumSum:
-                        val = el.sumData
-                    else:
-                        raise RuntimeError
-                    out[i] = val
+                out[i] = missing
+        else:
+            el = &elements[i]
+            if not result or el.validCount == 0:
+                out[i] = missing
+            else:
+                if summaryType == bbiSumMean:
+                    val = el.sumData / el.validCount
+                elif summaryType == bbiSumMax:
+                    val = el.maxVal
+                elif summaryType == bbiSumMin:
+                    val = el.minVal
+                elif summaryType == bbiSumCoverage:
+                    val = covFactor * el.validCount
+                elif summaryType == bbiSumStandardDeviation:
+                    val = sqrt(var_from_sums(el.sumData,
+                                             el.sumSquares,
+                                             el.validCount))
+                else:  # bbiSumSum
+                    val = el.sumData
+                out[i] = val
 
     # Destroy summary elements
     freeMem(elements)
 
 
+@cython.cdivision(True)
 cdef boolean _bbiSummariesFromZoom(
    bbiFile *bbi,
    bbiZoomLevel *zoom,
-   bytes chromName,
+   int chromId,
    int start,
    int end,
    int validStart,
    int validEnd,
    bbiSummaryElement *elements,
    int nbins
-):
+) nogil:
     # Look up region in index and get data at given zoom level.
     # Summarize this data in the summary array.
 
-    cdef int chromId = bbiChromId(bbi, chromName)
-    if chromId < 0:
-        return False
-
     # Find appropriate zoom-level summary data
     # summList is allocated
     cdef bbiSummary *summList = bbiSummariesInRegion(
@@ -963,22 +1768,23 @@ cdef boolean _bbiSummariesFromZoom(
     return result
 
 
+@cython.cdivision(True)
 cdef boolean _bbiSummariesFromFull(
     bbiFile *bbi,
+    lm *lm,
     BbiFetchIntervals fetchIntervals,
-    bytes chromName,
+    char *chromName,
     int start,
     int end,
     int validStart,
     int validEnd,
     bbiSummaryElement *elements,
     int nbins
-):
+) nogil:
     # Summarize data, not using zoom. Updates the summary elements.
 
     # Find appropriate interval elements
     # intervalList is allocated out of lm
-    cdef lm *lm = lmInit(0)
     cdef bbiInterval *intervalList = NULL
     intervalList = fetchIntervals(bbi, chromName, validStart, validEnd, lm)
 
@@ -1009,6 +1815,4 @@ cdef boolean _bbiSummariesFromFull(
             # Next time round start where we left off.
             baseStart = baseEnd
 
-    lmCleanup(&lm)
-
     return result
@@ -3,6 +3,9 @@
 set -o errexit
 set -o xtrace
 
+# Don't tune the extension for the build machine's CPU
+export PYBBI_PORTABLE=1
+
 mkdir -p /tmp/located
 mkdir -p /tmp/delocated
 mkdir -p /tmp/wheelhouse
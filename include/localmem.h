@@ -19,6 +19,11 @@ struct lm *lmInit(int blockSize);
 void lmCleanup(struct lm **pLm);
 /* Clean up a local memory pool. */
 
+void lmReset(struct lm *lm);
+/* Free everything allocated from a local memory pool, but keep its first
+ * block for reuse. The used part of that block is zeroed again, since
+ * memory handed out by lmAlloc is expected to be zeroed. */
+
 size_t lmAvailable(struct lm *lm);
 // Returns currently available memory in pool
 
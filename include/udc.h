@@ -37,6 +37,15 @@ struct udcFile *udcFileOpen(char *url, char *cacheDir);
 void udcFileClose(struct udcFile **pFile);
 /* Close down cached file. */
 
+boolean udcFileMmap(struct udcFile *file);
+/* Map a local (transparent) file into memory so that subsequent reads are
+ * copied out of the mapping instead of issuing read system calls.
+ * Return FALSE if the file is not local or could not be mapped. */
+
+int udcFileFd(struct udcFile *file);
+/* Return the file descriptor of a local (transparent) file, or -1 if the
+ * file is read through the cache. */
+
 bits64 udcRead(struct udcFile *file, void *buf, bits64 size);
 /* Read a block from file.  Return amount actually read. */
 
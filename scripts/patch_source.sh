@@ -14,3 +14,7 @@ tar -xzvf "v${VERSION}.tar.gz" ${INC_DIR} --strip-components=2 && mv inc include
 
 patch src/bbiRead.c < bbiRead.c.diff
 patch include/bbiFile.h < bbiFile.h.diff
+patch src/udc.c < udc.c.diff
+patch include/udc.h < udc.h.diff
+patch src/localmem.c < localmem.c.diff
+patch include/localmem.h < localmem.h.diff
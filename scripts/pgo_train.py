@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Training workload for the profile-guided build of libkent (`make build-pgo`).
+
+Exercises the hot query paths (binned and base pair fetches, stackups and
+interval iteration) on the bigWig and bigBed files in the test suite.
+
+"""
+import os.path as op
+
+import numpy as np
+
+import bbi
+
+
+thisdir = op.dirname(op.realpath(__file__))
+testdir = op.join(thisdir, '..', 'tests')
+FILES = [
+    op.join(testdir, 'bigWigExample.bw'),
+    op.join(testdir, 'bigBedExample.bb'),
+]
+
+
+def train(path, n=500, seed=0):
+    rng = np.random.RandomState(seed)
+    with bbi.open(path) as f:
+        chromsizes = f.chromsizes
+        chrom = max(chromsizes, key=chromsizes.get)
+
+        starts = rng.randint(0, chromsizes[chrom] - 10000, size=n)
+        ends = starts + 10000
+        chroms = [chrom] * n
+
+        for summary in ['mean', 'min', 'max', 'std', 'cov', 'sum']:
+            f.stackup(chroms, starts, ends, bins=100, summary=summary)
+        f.stackup(chroms, starts, ends, bins=100, exact=True)
+        f.stackup(chroms[:50], starts[:50], ends[:50])
+        for start, end in zip(starts[:50], ends[:50]):
+            f.fetch(chrom, start, end)
+            f.fetch(chrom, start, end, bins=10)
+            list(f.fetch_intervals(chrom, start, end))
+        f.fetch(chrom, 0, -1, bins=1000)
+
+
+if __name__ == '__main__':
+    for path in FILES:
+        train(path)
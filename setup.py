@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from setuptools import setup, Extension
-from setuptools.command.build_ext import build_ext as _build_ext
-from subprocess import check_call
+from setuptools.command.build_clib import build_clib as _build_clib
+try:
+    # Cythonizes in finalize_options and leaves build_extensions to setuptools
+    from Cython.Distutils.build_ext import new_build_ext as _build_ext
+except ImportError:
+    from setuptools.command.build_ext import build_ext as _build_ext
 from distutils import log
 import os.path as op
+import platform
+import hashlib
+import shutil
+import subprocess
+import json
+import glob
 import sys
 import os
 import re
@@ -14,112 +24,423 @@ import io
 thisdir = op.dirname(op.realpath(__file__))
 
 
-class lazylist(list):
+def get_machtype():
     '''
-    Used to delay the build-time Cython and numpy imports required to configure
-    our list of extension modules until after setup_requires has been processed.
+    Architecture the kent library is compiled for, following the Makefile: the
+    MACHTYPE env var unless unset or a GNU triplet, else the machine name.
 
     '''
-    def __init__(self, callback):
-        self._list = None
-        self.callback = callback
+    machtype = os.environ.get('MACHTYPE', '')
+    if not machtype or '-' in machtype:
+        machtype = platform.machine()
+    return machtype
 
-    def _cached_list(self):
-        if self._list is None:
-            self._list = self.callback()
-        return self._list
 
-    def __len__(self):
-        return len(self._cached_list())
-
-    def __iter__(self):
-        for e in self._cached_list():
-            yield e
-
-    def __getitem__(self, i):
-        return self._cached_list()[i]
+MACHTYPE = get_machtype()
 
 
 def read(*parts, **kwargs):
     encoding = kwargs.pop('encoding', 'utf-8')
     filepath = op.join(op.dirname(__file__), *parts)
-    return io.open(filepath, encoding=encoding).read()
+    with io.open(filepath, encoding=encoding) as f:
+        return f.read()
+
+
+VERSION_RE = re.compile(r'^__version__\s*=\s*[\'"]([^\'"]*)[\'"]')
 
 
 def get_version(pkg):
-    version = re.search(
-        r'^__version__\s*=\s*[\'"]([^\'"]*)[\'"]',
-        read(pkg, '__init__.py'),
-        re.MULTILINE).group(1)
-    return version
+    filepath = op.join(op.dirname(__file__), pkg, '__init__.py')
+    with io.open(filepath, encoding='utf-8') as f:
+        for line in f:
+            m = VERSION_RE.match(line)
+            if m:
+                return m.group(1)
+    raise RuntimeError('Unable to find version string in ' + filepath)
 
 
-class build_ext(_build_ext):
+def get_num_jobs():
+    '''
+    Number of parallel compile jobs: MAX_JOBS if set, else the CPU count.
+
+    '''
+    max_jobs = os.environ.get('MAX_JOBS')
+    if max_jobs:
+        return max(int(max_jobs), 1)
+    return os.cpu_count() or 1
+
+
+def parallelize_ccompiler(num_jobs):
+    '''
+    Patch distutils' CCompiler.compile to compile the sources of a library
+    or extension on a thread pool instead of one at a time.
+
+    '''
+    import distutils.ccompiler
+    from multiprocessing.pool import ThreadPool
+
+    def parallel_compile(self, sources, output_dir=None, macros=None,
+                         include_dirs=None, debug=0, extra_preargs=None,
+                         extra_postargs=None, depends=None):
+        macros, objects, extra_postargs, pp_opts, build = self._setup_compile(
+            output_dir, macros, include_dirs, sources, depends, extra_postargs)
+        cc_args = self._get_cc_args(pp_opts, debug, extra_preargs)
+
+        def _single_compile(obj):
+            try:
+                src, ext = build[obj]
+            except KeyError:
+                return
+            self._compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+
+        with ThreadPool(num_jobs) as pool:
+            list(pool.imap(_single_compile, objects))
+        return objects
+
+    distutils.ccompiler.CCompiler.compile = parallel_compile
+
+
+def existing_dirs(paths):
+    '''
+    Filter paths down to existing directories, with one scandir call per
+    distinct parent rather than a stat per path.
+
+    '''
+    listings = {}
+    out = []
+    for path in paths:
+        parent, name = op.split(op.normpath(path))
+        if parent not in listings:
+            try:
+                with os.scandir(parent) as it:
+                    listings[parent] = {e.name for e in it if e.is_dir()}
+            except OSError:
+                listings[parent] = set()
+        if name in listings[parent] and path not in out:
+            out.append(path)
+    return out
+
+
+def kent_sources():
+    '''
+    Sources of the kent library: those of the objects listed in src/makefile.
+
+    '''
+    text = read('src', 'makefile')
+    objects = re.search(r'^O = (.*?)\n\n', text, re.MULTILINE | re.DOTALL)
+    return [
+        op.join(thisdir, 'src', obj[:-len('.o')] + '.c')
+        for obj in objects.group(1).replace('\\\n', ' ').split()
+    ]
+
+
+def library_signature(build_info):
+    '''
+    SHA-256 digest of the headers and compiler settings of a build_clib
+    library, which its sources' mtimes alone don't capture.
+
+    '''
+    paths = sorted(
+        glob.glob(op.join(thisdir, 'src', '**', '*.h'), recursive=True) +
+        glob.glob(op.join(thisdir, 'include', '**', '*.h'), recursive=True)
+    )
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(op.relpath(path, thisdir).encode('utf-8'))
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    settings = [
+        build_info.get(key) for key in ('macros', 'include_dirs', 'cflags')
+    ]
+    settings.append(os.environ.get('CC'))
+    h.update(json.dumps(settings).encode('utf-8'))
+    return h.hexdigest()
+
+
+class build_clib(_build_clib):
     def run(self):
-        os.environ['SETUP_PY'] = '1'
+        # libkent is compiled here, before any extension module, whether we
+        # are run by build_ext or directly (e.g. by `build` or `bdist_wheel`),
+        # so the compiler is set up here too.
+        # Parallel builds are opt-in: concurrent jobs writing to the same
+        # object files can race if a previous build was interrupted.
+        num_jobs = self.get_finalized_command('build_ext').num_jobs()
+        if num_jobs > 1:
+            parallelize_ccompiler(num_jobs)
+
+        # An LTO archive needs an archiver that understands the LTO plugin
+        if os.environ.get('LTO'):
+            os.environ.setdefault('AR', os.environ.get('LTO_AR', 'gcc-ar'))
+
+        _build_clib.run(self)
 
-        # First, compile our C library: libkent.a
-        # import sysconfig
-        # log.info(sysconfig.get_config_vars())
-        # log.info("CPATH: " + os.environ.get("CPATH", ""))
-        # log.info("LIBRARY_PATH: " + os.environ.get("LIBRARY_PATH", ""))
+    def build_libraries(self, libraries):
+        # build_clib recompiles a library only if one of its sources is newer
+        # than its object. Keep a signature of the headers and compiler
+        # settings next to the objects, rewritten only when it changes, and
+        # make every object depend on it.
+        for lib_name, build_info in libraries:
+            sig_path = op.join(self.build_temp, lib_name + '.sig')
+            sig = library_signature(build_info)
+            old_sig = None
+            if op.exists(sig_path):
+                with open(sig_path) as f:
+                    old_sig = f.read().strip()
+            if sig != old_sig:
+                os.makedirs(self.build_temp, exist_ok=True)
+                with open(sig_path, 'w') as f:
+                    f.write(sig + '\n')
+            obj_deps = build_info.setdefault('obj_deps', {})
+            global_deps = obj_deps.setdefault('', [])
+            if sig_path not in global_deps:
+                global_deps.append(sig_path)
+        _build_clib.build_libraries(self, libraries)
+
+
+class build_ext(_build_ext):
+    def num_jobs(self):
+        # `build_ext --parallel N` (or `parallel = N` under [build_ext] in a
+        # config file such as $DIST_EXTRA_CONFIG) takes precedence over
+        # PYBBI_PARALLEL_BUILD.
+        if self.parallel:
+            if self.parallel is True:
+                return get_num_jobs()
+            return int(self.parallel)
+        if os.environ.get('PYBBI_PARALLEL_BUILD'):
+            return get_num_jobs()
+        return 1
+
+    def run(self):
+        # First, compile our C library, libkent.a, which also sets up the
+        # compiler for the extension modules. The extension modules link
+        # the archive by path, so that no other libkent.a on the search path
+        # (e.g. one built by `make build-ucsc`) can shadow it, and are relinked
+        # whenever it changes.
         log.info("Compiling libkent archive...")
-        check_call(['make', 'build-ucsc'])
+        self.run_command('build_clib')
+        build_clib = self.get_finalized_command('build_clib')
+        for lib_name, _ in self.distribution.libraries:
+            lib_path = build_clib.compiler.library_filename(
+                lib_name, output_dir=build_clib.build_clib)
+            for ext in self.extensions:
+                if lib_path not in ext.extra_objects:
+                    ext.extra_objects.append(lib_path)
+                    ext.depends.append(lib_path)
 
-        # Now, proceed to build extension modules
+        # Now, proceed to build extension modules. The stock build_extensions
+        # also honours self.parallel across extensions.
         log.info("Building extension module...")
         _build_ext.run(self)
 
 
-def get_ext_modules():
-    from Cython.Build import cythonize
-    import numpy
+def pkgconfig_files(exe, pkgs):
+    '''
+    The .pc files that pkg-config resolves pkgs to, with their mtimes, or
+    None if pkg-config can't resolve them.
+
+    '''
+    if not exe:
+        return None
+    try:
+        out = subprocess.run(
+            [exe, '--path'] + pkgs.split(),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True,
+        ).stdout
+        return [(path, op.getmtime(path)) for path in out.split()]
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_pkgconfig(pkgs):
+    '''
+    pkgconfig.parse(pkgs), cached in build/.pkgconfig_cache.json. The cache
+    is keyed on the packages, the pkg-config environment, the pkg-config
+    binary (path and mtime) and the .pc files it resolves (paths and mtimes),
+    so upgrading a package invalidates it. This replaces several pkg-config
+    calls per run with a single `pkg-config --path`.
+
+    '''
     import pkgconfig
+
+    exe = shutil.which(os.environ.get('PKG_CONFIG', 'pkg-config'))
+    key = json.dumps([
+        pkgs,
+        exe,
+        op.getmtime(exe) if exe else None,
+        [os.environ.get(var) for var in
+         ('PKG_CONFIG', 'PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR')],
+        pkgconfig_files(exe, pkgs),
+    ])
+    cache_path = op.join(thisdir, 'build', '.pkgconfig_cache.json')
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if key in cache:
+        d = cache[key]
+        # JSON has no tuples
+        if 'define_macros' in d:
+            d['define_macros'] = [tuple(m) for m in d['define_macros']]
+        return d
+
+    d = dict(pkgconfig.parse(pkgs))
+    try:
+        os.makedirs(op.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w') as f:
+            json.dump({key: d}, f)
+    except OSError:
+        pass
+    return d
+
+
+def needs_cython():
+    '''
+    Whether bbi/cbbi.c must be (re)generated: always if CYTHONIZE=1, else only
+    if it is missing or older than the Cython sources. The sdist ships the
+    generated C, so installing from it does not run Cython.
+
+    '''
+    if os.environ.get('CYTHONIZE') == '1':
+        return True
+    c_path = op.join(thisdir, 'bbi', 'cbbi.c')
+    if not op.exists(c_path):
+        return True
+    c_mtime = op.getmtime(c_path)
+    inputs = (glob.glob(op.join(thisdir, 'bbi', '*.pyx')) +
+              glob.glob(op.join(thisdir, 'bbi', '*.pxd')))
+    return any(op.getmtime(path) > c_mtime for path in inputs)
+
+
+def add_to_env(var, value, sep, prepend=False):
+    '''
+    Add value to the sep-separated environment variable var, unless it is
+    already one of its items.
+
+    '''
+    old = os.environ.get(var)
+    if not old:
+        os.environ[var] = value
+    elif value not in old.split(sep):
+        os.environ[var] = value + sep + old if prepend else old + sep + value
+
+
+def get_extensions():
+    '''
+    The kent static library for build_clib and the extension modules linking
+    it.
+
+    '''
+    import numpy
     import sysconfig
 
     # https://solitum.net/openssl-os-x-el-capitan-and-brew/
     if sys.platform == "darwin":
         s = '/usr/local/opt/openssl/lib/pkgconfig'
-        old = os.environ.get('PKG_CONFIG_PATH')
-        if old:
-            s = old + ':' + s
-        os.environ['PKG_CONFIG_PATH'] = s
+        if op.isdir(s):
+            add_to_env('PKG_CONFIG_PATH', s, ':')
         os.environ['MACOSX_DEPLOYMENT_TARGET'] = \
             sysconfig.get_config_var('MACOSX_DEPLOYMENT_TARGET')
-        os.environ['BLDSHARED'] = \
-            'gcc -bundle -undefined dynamic_lookup -arch x86_64 -g'
-        os.environ['LDSHARED'] = \
-            'gcc -bundle -undefined dynamic_lookup -arch x86_64 -g'
+        ldshared = 'gcc -bundle -undefined dynamic_lookup -arch x86_64 -g'
+        os.environ['BLDSHARED'] = ldshared
+        os.environ['LDSHARED'] = ldshared
+
+    # OpenMP is used to parallelize stackup queries. Apple's clang does not
+    # ship it, in which case the prange loops simply run serially.
+    openmp_flags = []
 
     if sys.platform == "linux":
-        s = '-Wl,--no-as-needed'
-        old = os.environ.get("LDFLAGS")
-        if old:
-            s = s + ' ' + old
-        os.environ["LDFLAGS"] = s
+        add_to_env('LDFLAGS', '-Wl,--no-as-needed', ' ', prepend=True)
+        openmp_flags = ['-fopenmp']
+
+    # Optional link-time and profile-guided optimization. Fat LTO objects
+    # keep libkent usable by a link step that does not pass -flto.
+    # PGO=generate instruments the build, PGO=use rebuilds it from the
+    # collected profiles (see `make build-pgo`).
+    # libkent's own optimization level, rather than whatever the
+    # interpreter's CFLAGS happen to carry (often -O2 or -Og)
+    kent_flags = ['-O3', '-pthread']
+    compile_flags = list(openmp_flags)
+    link_flags = list(openmp_flags)
+    if os.environ.get('LTO'):
+        kent_flags += ['-flto', '-ffat-lto-objects']
 
-    d = pkgconfig.parse('zlib openssl libpng')
+    # The extension is optimized for the build machine unless PYBBI_PORTABLE
+    # is set, as it must be for distributed wheels. -ffast-math is avoided
+    # because NaN fill values and NaN checks have to survive.
+    compile_flags += ['-O3', '-fno-math-errno']
+    if not os.environ.get('PYBBI_PORTABLE'):
+        compile_flags += ['-march=native', '-flto']
+        link_flags.append('-flto')
+    elif os.environ.get('LTO'):
+        compile_flags.append('-flto')
+        link_flags.append('-flto')
+    if os.environ.get('PGO') == 'generate':
+        kent_flags.append('-fprofile-generate')
+        link_flags.append('-fprofile-generate')
+    elif os.environ.get('PGO') == 'use':
+        kent_flags += [
+            '-fprofile-use', '-fprofile-correction', '-Wno-missing-profile'
+        ]
+
+    kent_macros = [
+        ('_FILE_OFFSET_BITS', '64'),
+        ('_LARGEFILE_SOURCE', None),
+        ('_GNU_SOURCE', None),
+        ('MACHTYPE_' + MACHTYPE, None),
+        ('USE_SSL', None),
+    ]
+    if os.environ.get('COREDUMP'):
+        kent_macros.append(('COREDUMP', None))
+
+    cython = needs_cython()
+    d = parse_pkgconfig('zlib openssl libpng')
+    # Drop -I dirs that don't exist, which the preprocessor would otherwise
+    # probe for every header lookup
+    d['include_dirs'] = existing_dirs(d.get('include_dirs', []))
+
+    libraries = [
+        ('kent', {
+            'sources': kent_sources(),
+            'macros': kent_macros,
+            'include_dirs': [
+                op.join(thisdir, 'include'),
+            ] + d['include_dirs'],
+            'cflags': kent_flags,
+        }),
+    ]
 
     ext_modules = [
         Extension(
             name='bbi.cbbi',
             sources=[
-                op.join(thisdir, 'bbi/cbbi.pyx')
+                op.join(thisdir, 'bbi/cbbi.pyx' if cython else 'bbi/cbbi.c')
             ],
-            libraries=[
-                'kent',
-            ] + d.pop('libraries', []),
-            library_dirs=[
-                op.join(thisdir, 'src/x86_64'),
-            ] + d.pop('library_dirs', []),
+            libraries=d.pop('libraries', []),
+            library_dirs=d.pop('library_dirs', []),
             include_dirs=[
                 numpy.get_include(),
                 op.join(thisdir, 'include'),
             ] + d.pop('include_dirs', []),
+            extra_compile_args=compile_flags,
+            extra_link_args=link_flags,
             **d
         ),
     ]
-    return cythonize(ext_modules)
+    if not cython:
+        log.info("Using pre-generated bbi/cbbi.c")
+        return libraries, ext_modules
+
+    from Cython.Build import cythonize
+
+    # Reuse the generated C when the Cython inputs are unchanged
+    cache_dir = os.environ.get(
+        'CYTHON_CACHE_DIR', op.join(thisdir, '.cython_cache'))
+    return libraries, cythonize(ext_modules, cache=cache_dir)
+
+
+libraries, ext_modules = get_extensions()
 
 
 setup(
@@ -143,22 +464,22 @@ setup(
         'Topic :: Scientific/Engineering :: Bio-Informatics',
     ],
     zip_safe=False,
-    setup_requires=[
-        'setuptools>=18.0',
-        'cython',
-        'numpy',
-        'pkgconfig'
-    ],
     install_requires=[
         'six',
-        'numpy'
+        'numpy>=1.19; python_version>="3.9"',
+        'numpy; python_version<"3.9"'
     ],
+    extras_require={
+        'build': ['cython'],
+    },
     tests_require=[
         'pytest',
         'pandas'
     ],
-    ext_modules=lazylist(get_ext_modules),
+    libraries=libraries,
+    ext_modules=ext_modules,
     cmdclass={
+        'build_clib': build_clib,
         'build_ext': build_ext
     }
 )
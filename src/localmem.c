@@ -74,6 +74,25 @@ void lmCleanup(struct lm **pLm)
     *pLm = NULL;
 }
 
+void lmReset(struct lm *lm)
+/* Free everything allocated from a local memory pool, but keep its first
+ * block for reuse. The used part of that block is zeroed again, since
+ * memory handed out by lmAlloc is expected to be zeroed. */
+{
+struct lmBlock *mb = lm->blocks, *next;
+if (mb == NULL)
+    return;
+while (mb->next != NULL)
+    {
+    next = mb->next;
+    freeMem(mb);
+    mb = next;
+    }
+lm->blocks = mb;
+memset(mb+1, 0, mb->free - (char *)(mb+1));
+mb->free = (char *)(mb+1);
+}
+
 size_t lmAvailable(struct lm *lm)
 // Returns currently available memory in pool
 {
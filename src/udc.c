@@ -24,6 +24,7 @@
  * for each block of the file that has been fetched.  Currently the block size is 8K. */
 
 #include <sys/file.h>
+#include <sys/mman.h>
 #include "common.h"
 #include "hash.h"
 #include "obscure.h"
@@ -140,6 +141,7 @@ struct udcFile
     bits32 bitmapVersion;	/* Version of associated bitmap we were opened with. */
     struct connInfo connInfo;   /* Connection info for open net connection. */
     struct ios ios;             /* Statistics on file access. */
+    char *mmapBuf;              /* Memory mapping of a local file, if any. */
     };
 
 struct udcBitmap
@@ -1256,6 +1258,8 @@ if (file != NULL)
     freeMem(file->bitmapFileName);
     freeMem(file->sparseFileName);
     freeMem(file->sparseReadAheadBuf);
+    if (file->mmapBuf != NULL)
+        munmap(file->mmapBuf, file->size);
     if (file->fdSparse != 0)
         mustCloseFd(&(file->fdSparse));
     udcBitmapClose(&file->bits);
@@ -1568,11 +1572,52 @@ for (s = offset; s < endPos; s = e)
 return ok;
 }
 
+boolean udcFileMmap(struct udcFile *file)
+/* Map a local (transparent) file into memory so that subsequent reads are
+ * copied out of the mapping instead of issuing read system calls.
+ * Return FALSE if the file is not local or could not be mapped. */
+{
+if (file->mmapBuf != NULL)
+    return TRUE;
+if (!sameString(file->protocol, "transparent") || file->size == 0)
+    return FALSE;
+void *buf = mmap(NULL, file->size, PROT_READ, MAP_SHARED, file->fdSparse, 0);
+if (buf == MAP_FAILED)
+    return FALSE;
+file->mmapBuf = buf;
+return TRUE;
+}
+
+int udcFileFd(struct udcFile *file)
+/* Return the file descriptor of a local (transparent) file, or -1 if the
+ * file is read through the cache. */
+{
+if (!sameString(file->protocol, "transparent"))
+    return -1;
+return file->fdSparse;
+}
+
+static bits64 udcReadMmap(struct udcFile *file, void *buf, bits64 size)
+/* Read a block from the memory mapping of a local file. */
+{
+bits64 start = file->offset;
+if (start > file->size)
+    return 0;
+if (start + size > file->size)
+    size = file->size - start;
+memcpy(buf, file->mmapBuf + start, size);
+file->offset += size;
+file->ios.udc.bytesRead += size;
+return size;
+}
+
 #define READAHEADBUFSIZE 4096
 bits64 udcRead(struct udcFile *file, void *buf, bits64 size)
 /* Read a block from file.  Return amount actually read. */
 {
 file->ios.udc.numReads++;
+if (file->mmapBuf != NULL)
+    return udcReadMmap(file, buf, size);
 // if not caching, just fetch the data
 if (!udcCacheEnabled() && !sameString(file->protocol, "transparent"))
     {
@@ -1842,7 +1887,7 @@ void udcSeekCur(struct udcFile *file, bits64 offset)
 {
 file->ios.udc.numSeeks++;
 file->offset += offset;
-if (udcCacheEnabled())
+if (udcCacheEnabled() && file->mmapBuf == NULL)
     ourMustLseek(&file->ios.sparse,file->fdSparse, offset, SEEK_CUR);
 }
 
@@ -1851,7 +1896,7 @@ void udcSeek(struct udcFile *file, bits64 offset)
 {
 file->ios.udc.numSeeks++;
 file->offset = offset;
-if (udcCacheEnabled())
+if (udcCacheEnabled() && file->mmapBuf == NULL)
     ourMustLseek(&file->ios.sparse,file->fdSparse, offset, SEEK_SET);
 }
 
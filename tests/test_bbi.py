@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import division, print_function
+import os
 import os.path as op
+import pickle
+import shutil
 import numpy as np
 
 import bbi
@@ -17,6 +20,29 @@ bbi_paths = [BW_FILE, BB_FILE]
 bbi_urls = [BW_URL, BB_URL]
 
 
+@pytest.fixture(scope='session', params=bbi_paths)
+def bbi_file(request):
+    # One open handle per file, shared by the read-only tests
+    with bbi.open(request.param) as f:
+        yield f
+
+
+@pytest.fixture(scope='session')
+def open_remote():
+    # Open each URL once, so the remote tests share the connection setup and
+    # the header and index fetches
+    handles = {}
+
+    def _open(url):
+        if url not in handles:
+            handles[url] = bbi.open(url)
+        return handles[url]
+
+    yield _open
+    for f in handles.values():
+        f.close()
+
+
 def test_sigs():
     assert bbi.is_bbi(BW_FILE)
     assert bbi.is_bigwig(BW_FILE)
@@ -58,6 +84,46 @@ def test_chromsizes(uri):
     assert len(chromsizes) == 1 and 'chr21' in chromsizes
 
 
+def test_chrom_index(bbi_file):
+    f = bbi_file
+    chromsizes = f.chromsizes
+    assert pickle.loads(pickle.dumps(chromsizes)) == chromsizes
+    chromsizes['chr21'] = 0
+    assert f.chromsizes['chr21'] > 0
+    assert f.chrom_index('chr21') == list(f.chromsizes).index('chr21')
+    with pytest.raises(KeyError):
+        f.chrom_index('chr1')
+
+
+def test_fetch_by_id(bbi_file):
+    f = bbi_file
+    ix = f.chrom_index('chr21')
+    x = f.fetch('chr21', 20000000, 20010000)
+    y = f.fetch_by_id(ix, 20000000, 20010000)
+    assert np.allclose(x, y, equal_nan=True)
+    x = f.fetch('chr21', 0, -1, bins=100)
+    y = f.fetch_by_id(ix, 0, -1, bins=100)
+    assert np.allclose(x, y, equal_nan=True)
+    with pytest.raises(IndexError):
+        f.fetch_by_id(len(f.chromsizes), 0, 1000)
+
+
+@pytest.mark.parametrize('path', bbi_paths)
+def test_function_api_metadata(path):
+    with bbi.open(path) as f:
+        assert bbi.chromsizes(path) == f.chromsizes
+        assert bbi.zooms(path) == f.zooms
+        assert bbi.info(path)['summary'] == f.info['summary']
+
+    chromsizes = bbi.chromsizes(path)
+    chromsizes['chr21'] = 0
+    assert bbi.chromsizes(path)['chr21'] > 0
+    info = bbi.info(path)
+    info['summary']['sum'] = 0
+    assert bbi.info(path)['summary']['sum'] != 0
+    assert isinstance(bbi.zooms(path), list)
+
+
 @pytest.mark.parametrize('path', bbi_paths)
 def test_fetch(path):
     with bbi.open(path) as f:
@@ -73,54 +139,73 @@ def test_fetch(path):
             f.fetch('chr1', 0, 1000)
 
 
-def test_fetch_remote():
+@pytest.mark.parametrize('path', bbi_paths)
+def test_fetch_mmap(path):
+    with bbi.open(path) as f, bbi.open(path, mmap=True) as g:
+        assert f.chromsizes == g.chromsizes
+        x = f.fetch('chr21', 20000000, 20010000)
+        y = g.fetch('chr21', 20000000, 20010000)
+        assert np.allclose(x, y, equal_nan=True)
+        x = f.fetch('chr21', 0, -1, bins=100)
+        y = g.fetch('chr21', 0, -1, bins=100)
+        assert np.allclose(x, y, equal_nan=True)
+
+
+@pytest.mark.parametrize('path', bbi_paths)
+def test_fd(path):
+    f = bbi.open(path)
+    assert os.fstat(f.fd).st_size == os.path.getsize(path)
+    f.close()
+    with pytest.raises(OSError):
+        f.fd
+
+
+def test_fetch_remote(open_remote):
     x_local = bbi.open(BW_FILE).fetch('chr21', 0, 100)
-    x_remote = bbi.open(BW_URL).fetch('chr21', 0, 100)
+    x_remote = open_remote(BW_URL).fetch('chr21', 0, 100)
     assert np.allclose(x_local, x_remote, equal_nan=True)
 
     x_local = bbi.open(BB_FILE).fetch('chr21', 0, 100)
-    x_remote = bbi.open(BB_URL).fetch('chr21', 0, 100)
+    x_remote = open_remote(BB_URL).fetch('chr21', 0, 100)
     assert np.allclose(x_local, x_remote, equal_nan=True)
 
 
-def test_fetch_remote_https():
+def test_fetch_remote_https(open_remote):
     x_local = bbi.open(BW_FILE).fetch('chr21', 0, 100)
-    x_remote = bbi.open(BW_URL.replace('http://', 'https://')).fetch(
+    x_remote = open_remote(BW_URL.replace('http://', 'https://')).fetch(
         'chr21', 0, 100
     )
     assert np.allclose(x_local, x_remote, equal_nan=True)
 
     x_local = bbi.open(BB_FILE).fetch('chr21', 0, 100)
-    x_remote = bbi.open(BB_URL.replace('http://', 'https://')).fetch(
+    x_remote = open_remote(BB_URL.replace('http://', 'https://')).fetch(
         'chr21', 0, 100
     )
     assert np.allclose(x_local, x_remote, equal_nan=True)
 
 
-@pytest.mark.parametrize('path', bbi_paths)
-def test_fetch_missing(path):
-    f = bbi.open(path)
+def test_fetch_missing(bbi_file):
+    f = bbi_file
 
     x = f.fetch('chr21', 0, 1000, oob=0)
-    assert np.all(x[:10] == 0)
+    assert np.count_nonzero(x[:10]) == 0
     x = f.fetch('chr21', 0, 1000, missing=np.nan)
-    assert np.all(np.isnan(x[:10]))
+    assert np.isnan(x[:10]).all()
 
 
-@pytest.mark.parametrize('path', bbi_paths)
-def test_fetch_oob(path):
-    f = bbi.open(path)
+def test_fetch_oob(bbi_file):
+    f = bbi_file
 
     x = f.fetch('chr21', -10, 1000, oob=np.nan)
-    assert np.all(np.isnan(x[:10]))
+    assert np.isnan(x[:10]).all()
     x = f.fetch('chr21', -10, 1000, oob=0)
-    assert np.all(x[:10] == 0)
+    assert np.count_nonzero(x[:10]) == 0
 
     n = f.chromsizes['chr21']
     x = f.fetch('chr21', n - 1000, n + 10, oob=np.nan)
-    assert np.all(np.isnan(x[-10:]))
+    assert np.isnan(x[-10:]).all()
     x = f.fetch('chr21', n - 1000, n + 10, oob=0)
-    assert np.all(x[-10:] == 0)
+    assert np.count_nonzero(x[-10:]) == 0
 
 
 @pytest.mark.parametrize('path', bbi_paths)
@@ -141,8 +226,27 @@ def test_fetch_intervals(path):
 
 
 @pytest.mark.parametrize('path', bbi_paths)
-def test_fetch_summary_stats(path):
-    f = bbi.open(path)
+def test_fetch_intervals_arrays(path):
+    assert list(bbi.fetch_intervals_arrays(path, 'chr21', 0, 1000)) == []
+
+    with bbi.open(path) as f:
+        records = list(f.fetch_intervals('chr21', 0, 20000000, iterator=True))
+        chunks = list(
+            f.fetch_intervals_arrays('chr21', 0, 20000000, chunksize=1000))
+        assert all(len(chunk[0]) <= 1000 for chunk in chunks)
+        starts = np.concatenate([chunk[0] for chunk in chunks])
+        ends = np.concatenate([chunk[1] for chunk in chunks])
+        assert np.array_equal(starts, [rec[1] for rec in records])
+        assert np.array_equal(ends, [rec[2] for rec in records])
+        if f.is_bigwig:
+            values = np.concatenate([chunk[2] for chunk in chunks])
+            assert np.allclose(values, [rec[3] for rec in records])
+        else:
+            assert all(len(chunk) == 2 for chunk in chunks)
+
+
+def test_fetch_summary_stats(bbi_file):
+    f = bbi_file
 
     x = f.fetch('chr21', 20000000, 20001000, bins=10, summary='mean')
     y = f.fetch('chr21', 20000000, 20001000, bins=10)
@@ -158,7 +262,9 @@ def test_fetch_summary_stats(path):
     ).max()
     assert np.isclose(vmax, np.max(values))
     vsum = f.fetch('chr21', 20000000, 20001000, bins=100, summary='sum')
-    values_sum_every_ten = np.reshape(values, (-1, 10)).sum(axis=-1)
+    values_sum_every_ten = np.add.reduceat(
+        values, np.arange(0, len(values), 10)
+    )
     assert len(vsum) == len(values_sum_every_ten)
     assert np.allclose(vsum, values_sum_every_ten)
 
@@ -166,9 +272,45 @@ def test_fetch_summary_stats(path):
         f.fetch('chr21', 20000000, 20001000, bins=10, summary='foo')
 
 
-@pytest.mark.parametrize('path', bbi_paths)
-def test_stackup(path):
-    f = bbi.open(path)
+def test_fetch_exact(bbi_file):
+    f = bbi_file
+    start, end = 20000000, 20100000
+    values = f.fetch('chr21', start, end)
+    binned = np.reshape(values, (100, -1))
+
+    x = f.fetch('chr21', start, end, bins=100, summary='sum', exact=True)
+    assert np.allclose(x, binned.sum(axis=-1))
+    x = f.fetch('chr21', start, end, bins=100, summary='max', exact=True)
+    assert np.allclose(x, binned.max(axis=-1))
+
+    x = f.stackup(
+        ['chr21'], [start], [end], bins=100, summary='sum', exact=True
+    )
+    assert np.allclose(x[0], binned.sum(axis=-1))
+
+
+def test_fetch_dtype(bbi_file):
+    f = bbi_file
+    x = f.fetch('chr21', 20000000, 20010000)
+    y = f.fetch('chr21', 20000000, 20010000, dtype=np.float64)
+    assert x.dtype == np.float32
+    assert y.dtype == np.float64
+    assert np.allclose(x, y, equal_nan=True)
+
+    x = f.stackup(['chr21'] * 3, [0, 10000000, 20000000],
+                  [1000000, 11000000, 21000000], bins=10)
+    y = f.stackup(['chr21'] * 3, [0, 10000000, 20000000],
+                  [1000000, 11000000, 21000000], bins=10, dtype=np.float64)
+    assert x.dtype == np.float32
+    assert y.dtype == np.float64
+    assert np.allclose(x, y, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        f.fetch('chr21', 0, 100, dtype=np.int64)
+
+
+def test_stackup(bbi_file):
+    f = bbi_file
 
     x = f.stackup(['chr21', 'chr21'], [0, 2000], [1000, 3000])
     assert x.shape == (2, 1000)
@@ -184,6 +326,234 @@ def test_stackup(path):
     assert x.shape == (2, 10)
 
 
+def test_stackup_order(bbi_file):
+    f = bbi_file
+    starts = np.array([30000000, 20000000, 25000000, 20000000])
+    chroms = ['chr21'] * len(starts)
+
+    x = f.stackup(chroms, starts, starts + 1000, bins=10)
+    y = f.stackup(chroms, starts, starts + 1000, bins=10, presorted=True)
+    assert np.allclose(x, y, equal_nan=True)
+    for row, start in zip(x, starts):
+        expected = f.fetch('chr21', start, start + 1000, bins=10)
+        assert np.allclose(row, expected, equal_nan=True)
+
+
+def test_stackup_numpy_chrom_names(bbi_file):
+    f = bbi_file
+    chroms = list(np.array(['chr21', 'chr21']))
+    assert type(chroms[0]) is np.str_
+    x = f.stackup(chroms, [20000000, 20001000], [20001000, 20002000])
+    y = f.stackup(['chr21', 'chr21'], [20000000, 20001000], [20001000, 20002000])
+    assert np.allclose(x, y, equal_nan=True)
+    xs = f.fetch_batch(chroms, [20000000, 20001000], [20001000, 20002000])
+    assert np.allclose(xs, y, equal_nan=True)
+
+
+def test_stackup_many_chroms():
+    f = bbi.open(op.join(thisdir, 'bigGenePred.bb'))
+    chroms = ['chr10', 'chr1', 'chr10', 'chr2', 'chr1']
+    starts = np.array([1000000, 1000000, 500000, 1000000, 2000000])
+
+    x = f.stackup(chroms, starts, starts + 100000, bins=10)
+    for row, chrom, start in zip(x, chroms, starts):
+        expected = f.fetch(chrom, start, start + 100000, bins=10)
+        assert np.allclose(row, expected, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        f.stackup(['chr1', 'chr10'], [0, 10 ** 9], [1000, 10 ** 9 + 1000])
+
+
+def test_stackup_threads(bbi_file):
+    f = bbi_file
+    starts = np.arange(19000000, 21000000, 50000)
+    chroms = ['chr21'] * len(starts)
+
+    x = f.stackup(chroms, starts - 500, starts + 500)
+    y = f.stackup(chroms, starts - 500, starts + 500, nthreads=4)
+    assert np.allclose(x, y, equal_nan=True)
+
+    x = f.stackup(chroms, starts, starts + 20000, bins=20, summary='max')
+    y = f.stackup(chroms, starts, starts + 20000, bins=20, summary='max', nthreads=4)
+    assert np.allclose(x, y, equal_nan=True)
+    y = f.stackup(chroms, starts, starts + 20000, 20, 0.0, np.nan, 'max', 4)
+    assert np.allclose(x, y, equal_nan=True)
+
+    for row, start in zip(x, starts):
+        expected = f.fetch('chr21', start, start + 20000, bins=20, summary='max')
+        assert np.allclose(row, expected, equal_nan=True)
+
+
+def test_stackup_fortran_order(bbi_file):
+    f = bbi_file
+    starts = np.arange(19000000, 21000000, 50000)
+    chroms = ['chr21'] * len(starts)
+
+    for kwargs in [{}, {'bins': 20}, {'bins': 20, 'dtype': np.float64}]:
+        x = f.stackup(chroms, starts, starts + 1000, **kwargs)
+        y = f.stackup(chroms, starts, starts + 1000, order='F', **kwargs)
+        z = f.stackup(chroms, starts, starts + 1000, order='F', nthreads=4, **kwargs)
+        assert y.flags.f_contiguous and y.dtype == x.dtype
+        assert np.allclose(x, y, equal_nan=True)
+        assert np.allclose(x, z, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        f.stackup(chroms, starts, starts + 1000, order='A')
+
+
+@pytest.mark.parametrize('path', bbi_paths)
+def test_function_api_reuses_handles(path, tmp_path):
+    from bbi._bbi import _open_cached
+
+    copy = str(tmp_path / op.basename(path))
+    shutil.copyfile(path, copy)
+    bbi.close_all()
+    x = bbi.fetch(copy, 'chr21', 0, 1000)
+    info = _open_cached.cache_info()
+    y = bbi.fetch(copy, 'chr21', 0, 1000)
+    assert np.allclose(x, y, equal_nan=True)
+    assert _open_cached.cache_info().hits == info.hits + 1
+    assert _open_cached.cache_info().misses == info.misses
+    assert bbi.chromsizes(copy) == bbi.open(copy).chromsizes
+
+    # A modified file is reopened
+    st = os.stat(copy)
+    os.utime(copy, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    z = bbi.fetch(copy, 'chr21', 0, 1000)
+    assert np.allclose(x, z, equal_nan=True)
+    assert _open_cached.cache_info().misses == info.misses + 1
+
+    bbi.close_all()
+    assert _open_cached.cache_info().currsize == 0
+    z = bbi.fetch(copy, 'chr21', 0, 1000)
+    assert np.allclose(x, z, equal_nan=True)
+    bbi.close_all()
+
+
+def _fd_pos(fd):
+    with open('/proc/self/fdinfo/{}'.format(fd)) as f:
+        return int(f.readline().split()[1])
+
+
+@pytest.mark.skipif(
+    not hasattr(os, 'posix_fadvise') or not op.isdir('/proc/self/fdinfo'),
+    reason='requires posix_fadvise and /proc'
+)
+@pytest.mark.parametrize('path', bbi_paths)
+def test_stackup_advises_reading_handles(path, monkeypatch):
+    # The read-ahead hint is per open file, so it must reach the handles that
+    # actually read the data
+    advised = []
+    posix_fadvise = os.posix_fadvise
+
+    def record(fd, offset, length, advice):
+        advised.append((fd, advice, _fd_pos(fd)))
+        posix_fadvise(fd, offset, length, advice)
+
+    monkeypatch.setattr(os, 'posix_fadvise', record)
+    bbi.chromsizes(path)
+    for start in [30000000, 40000000]:
+        del advised[:]
+        bbi.stackup(path, ['chr21'] * 2, [start, start + 10000],
+                    [start + 1000, start + 11000])
+        (fd, advice, before), (fd2, advice2, after) = advised
+        assert fd2 == fd
+        assert advice == os.POSIX_FADV_SEQUENTIAL
+        assert advice2 == os.POSIX_FADV_NORMAL
+        assert after != before
+
+    del advised[:]
+    bbi.stackup(path, ['chr21'] * 4, [30000000] * 4, [30001000] * 4,
+                nthreads=2)
+    sequential = {fd for fd, advice, _ in advised
+                  if advice == os.POSIX_FADV_SEQUENTIAL}
+    assert len(sequential) == 2
+
+
+def test_fetch_batch(bbi_file):
+    f = bbi_file
+    chroms = ['chr21', 'chr21', 'chr21']
+    starts = [-10, 20000000, 20000000]
+    ends = [1000, 20001000, 20003000]
+
+    xs = f.fetch_batch(chroms, starts, ends)
+    assert [len(x) for x in xs] == [1010, 1000, 3000]
+    for x, start, end in zip(xs, starts, ends):
+        assert np.allclose(x, f.fetch('chr21', start, end), equal_nan=True)
+
+    xs = f.fetch_batch(chroms, starts, ends, bins=10, summary='max')
+    assert [len(x) for x in xs] == [10, 10, 10]
+    for x, start, end in zip(xs, starts, ends):
+        y = f.fetch('chr21', start, end, bins=10, summary='max')
+        assert np.allclose(x, y, equal_nan=True)
+
+    xs = bbi.fetch_batch(f.path, chroms, starts, ends, bins=10)
+    assert len(xs) == 3
+
+    with pytest.raises(ValueError):
+        f.fetch_batch(chroms, starts[:2], ends)
+
+    with pytest.raises(KeyError):
+        f.fetch_batch(['chr1'], [0], [1000])
+
+
+@pytest.mark.parametrize('path', bbi_paths)
+def test_fetch_threaded(path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    starts = np.arange(20000000, 20100000, 10000)
+    expected = [bbi.fetch(path, 'chr21', s, s + 10000, bins=10) for s in starts]
+    with ThreadPoolExecutor(4) as pool:
+        result = list(pool.map(
+            lambda s: bbi.fetch(path, 'chr21', s, s + 10000, bins=10), starts
+        ))
+    assert np.allclose(expected, result, equal_nan=True)
+
+
+@pytest.mark.parametrize('path', bbi_paths)
+def test_fetch_threaded_shared_handle(path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    starts = np.arange(20000000, 21000000, 10000)
+    with bbi.open(path) as f:
+        def work(s):
+            return (
+                f.fetch('chr21', s, s + 2000),
+                f.fetch('chr21', s, s + 10000, bins=10),
+                f.stackup(['chr21'] * 3, [s] * 3, [s + 1000] * 3, nthreads=2),
+            )
+        expected = [work(s) for s in starts]
+        with ThreadPoolExecutor(8) as pool:
+            result = list(pool.map(work, starts))
+    for r, e in zip(result, expected):
+        for x, y in zip(r, e):
+            assert np.allclose(x, y, equal_nan=True)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork()')
+@pytest.mark.parametrize('path', bbi_paths)
+def test_function_api_after_fork(path):
+    from bbi._bbi import _open_cached
+
+    expected = bbi.fetch(path, 'chr21', 20000000, 20100000, bins=10)
+    assert _open_cached.cache_info().currsize > 0
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        ok = False
+        try:
+            ok = _open_cached.cache_info().currsize == 0 and np.allclose(
+                bbi.fetch(path, 'chr21', 20000000, 20100000, bins=10),
+                expected,
+                equal_nan=True,
+            )
+        finally:
+            os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    result = bbi.fetch(path, 'chr21', 20000000, 20100000, bins=10)
+    assert np.allclose(result, expected, equal_nan=True)
+
+
 def test_aws_403_redirect():
     # See https://stat.ethz.ch/pipermail/bioc-devel/2016-May/009241.html
     url = 'https://www.encodeproject.org/files/ENCFF620UMO/@@download/ENCFF620UMO.bigWig'